@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+"""AsyncThunderDriveAPI against the local stub server (needs aiohttp)
+
+    python3 bench/async_client.py [listings] [files] [file_size]
+
+Runs the listings and downloads all at once on one event loop, then an
+upload and a folder creation, checks every downloaded byte, and prints
+how long the loop was held up at most while they ran (a timer
+coroutine that should wake every 10 ms). The stub server runs in the
+same process, so its threads take their share of the GIL.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+from thunderdrive import AsyncThunderDriveAPI  # noqa: E402
+from stubserver import StubDrive  # noqa: E402
+
+
+async def ticker(stop, lags):
+    while not stop.is_set():
+        before = time.monotonic()
+        await asyncio.sleep(0.01)
+        lags.append(time.monotonic() - before - 0.01)
+
+
+async def main(listings, files, file_size):
+    drive = StubDrive()
+    folder = drive.folders[0]
+    drive.add_files(files, file_size, folder["id"])
+    os.chdir(tempfile.mkdtemp())
+
+    async with AsyncThunderDriveAPI("u", "p", url=drive.url) as thunder_cl:
+        entries = await thunder_cl.get_folder_entries(folder["hash"])
+        stop, lags = asyncio.Event(), []
+        tick = asyncio.ensure_future(ticker(stop, lags))
+        beg = time.monotonic()
+        results = await asyncio.gather(
+            *[thunder_cl.get_folder_entries(folder["hash"])
+              for _ in range(listings)],
+            *[thunder_cl.download_file_with_retry(x) for x in entries])
+        elapsed = time.monotonic() - beg
+        stop.set()
+        await tick
+        assert all(len(r) == files for r in results[:listings])
+        for entry in entries:
+            with open(entry["name"], "rb") as f:
+                assert f.read() == drive.files[entry["hash"]], entry["name"]
+
+        with open("up.txt", "wb") as f:
+            f.write(b"hello")
+        await thunder_cl.upload_file_with_retry("up.txt", folder["id"])
+        assert drive.files[drive.entries[-1]["hash"]] == b"hello"
+        made = await thunder_cl.make_folder("New", folder["id"])
+        assert made["status"] == "success"
+    drive.close()
+
+    print("{} listings + {} downloads of {} in {:.2f}s ({} requests)".
+          format(listings, files, file_size, elapsed, drive.count()))
+    print("longest event loop stall: {:.1f} ms".format(max(lags) * 1000))
+    print("OK")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    args = [int(x) for x in sys.argv[1:]]
+    asyncio.run(main(*(args + [500, 20, 16 * 1024 * 1024][len(args):])))
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+"""client cpu seconds per GB downloaded from the local stub server
+
+    python3 bench/download_cpu.py [size_mb] [chunk sizes,...]
+
+The stub runs in its own process, so only the client's cpu time is
+counted. "iter_content" is the download loop the client had before
+(512K chunks from iter_content into a buffered file, no .part journal;
+the second row adds the one fsync every download_file ends with).
+The other rows are ThunderDriveAPI.download_file with each chunk size:
+reads of what has arrived (up to the chunk size), the .part file
+preallocated (or not), and the journal committed with an fsync every
+PartialDownload.commit_interval seconds. Best of three runs each.
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+from thunderdrive import ThunderDriveAPI, Tools  # noqa: E402
+
+
+def iter_content_download(thunder_cl, entry, fsync=False):
+    r = thunder_cl.get(thunder_cl.URL + "uploads/download",
+                       params=[('hashes', entry["hash"])],
+                       convert_to_json=False, stream=True)
+    with open(entry["name"], "wb") as f:
+        for ch in r.iter_content(chunk_size=1024 * 512):
+            f.write(ch)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def client_download(chunk_size, preallocate=True):
+    def download(thunder_cl, entry):
+        thunder_cl.chunk_size = chunk_size
+        thunder_cl.preallocate_downloads = preallocate
+        thunder_cl.download_file(entry)
+    return download
+
+
+def cpu_per_gb(thunder_cl, entry, download):
+    best = None
+    for _ in range(3):
+        if os.path.exists(entry["name"]):
+            os.remove(entry["name"])
+        beg = time.process_time()
+        download(thunder_cl, entry)
+        cpu = time.process_time() - beg
+        assert os.path.getsize(entry["name"]) == entry["file_size"]
+        best = cpu if best is None else min(best, cpu)
+    return best * (1 << 30) / entry["file_size"]
+
+
+def main(size_mb, chunk_sizes):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(__file__),
+                                      "stubserver.py"),
+         "0", "1", str(size_mb * 1024 * 1024)], stdout=subprocess.PIPE,
+        text=True)
+    try:
+        url = server.stdout.readline().strip()
+        os.chdir(tempfile.mkdtemp())
+        with ThunderDriveAPI("u", "p", logging.getLogger(),
+                             url=url) as thunder_cl:
+            thunder_cl.showprogressbar = False
+            entry = [x for x in thunder_cl.get_folder_entries()
+                     if x["type"] != "folder"][0]
+            rows = [("iter_content 512K", iter_content_download),
+                    ("  fsync at the end", lambda thunder_cl, entry:
+                     iter_content_download(thunder_cl, entry, fsync=True))]
+            rows += [("download_file " + Tools.sizeof_fmt(size),
+                      client_download(size)) for size in chunk_sizes]
+            rows += [("  {} not preallocated".format(Tools.sizeof_fmt(
+                ThunderDriveAPI.chunk_size)), client_download(
+                    ThunderDriveAPI.chunk_size, preallocate=False))]
+            print("{} download, client cpu s/GB:".format(
+                Tools.sizeof_fmt(entry["file_size"])))
+            for label, download in rows:
+                print("  {:<24} {:.2f}".format(
+                    label, cpu_per_gb(thunder_cl, entry, download)))
+            os.remove(entry["name"])
+    finally:
+        server.kill()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 512,
+         [Tools.parse_size(x) for x in
+          (sys.argv[2] if len(sys.argv) > 2 else "512K,1M,4M").split(",")])
@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+"""listing requests/s of ThunderDriveAPI against the local stub server
+
+    python3 bench/listing.py [count] [jobs,...] [pool sizes,...]
+
+Times count root listings (ThunderDriveAPI.benchmark_listing) for every
+jobs x pool size pair; pool size 0 is the default, sized to the jobs.
+A pool smaller than the jobs throws connections away after use, so
+that row shows the cost of losing keep-alive.
+"""
+
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+from thunderdrive import ThunderDriveAPI  # noqa: E402
+from stubserver import StubDrive  # noqa: E402
+
+
+def main(count, jobs_list, pool_sizes):
+    drive = StubDrive()
+    drive.add_files(40, 10)
+    with ThunderDriveAPI("u", "p", logging.getLogger(),
+                         url=drive.url) as thunder_cl:
+        thunder_cl.count_requests = True
+        print("{:>5} {:>5} {:>12}".format("jobs", "pool", "requests/s"))
+        for jobs in jobs_list:
+            thunder_cl.set_jobs(jobs)
+            for pool_size in pool_sizes:
+                thunder_cl.set_pool_size(pool_size)
+                # warm up the connections
+                thunder_cl.benchmark_listing(jobs * 2, jobs)
+                rate = thunder_cl.benchmark_listing(count, jobs)
+                print("{:>5} {:>5} {:>12.0f}".format(
+                    jobs, thunder_cl._pool_maxsize, rate))
+    drive.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    # "pool is full, discarding connection" for every small-pool request
+    logging.getLogger("urllib3").setLevel(logging.ERROR)
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 2000,
+         [int(x) for x in (args[1] if len(args) > 1 else "1,4,16").
+          split(",")],
+         [int(x) for x in (args[2] if len(args) > 2 else "1,0").split(",")])
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+"""requests per CLI run, against the local stub server
+
+    python3 bench/startup.py
+
+Runs thunderdrive.py's param_mode for a few common commands and counts
+the requests the stub gets, once as is and once with the root listing,
+user id and folder list fetched right after login, as the client did
+before they were made lazy.
+"""
+
+import logging
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import thunderdrive  # noqa: E402
+from stubserver import StubDrive  # noqa: E402
+
+MODES = [["--search=file1", "--list"],
+         ["--printrecent=3"],
+         ["--downloadmode", "file2.bin"],
+         ["--uploadmode", "--targetdir=Docs", "config.txt"]]
+
+
+def eager_init(init):
+    def wrapper(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        if not self.offline:
+            self.last_resp, self.userID, self.allFolders
+    return wrapper
+
+
+def run(drive, argv):
+    before = len(drive.requests)
+    try:
+        thunderdrive.param_mode(["thunderdrive.py", "--disableprogressbar"] +
+                                argv, logging.getLogger())
+    except SystemExit:
+        pass
+    return [path for _, path in drive.requests[before:]]
+
+
+def main():
+    drive = StubDrive()
+    drive.add_files(7, 1000, drive.folders[0]["id"])
+    for i in range(3):
+        drive.add_file("notes{}.txt".format(i), b"x" * 1000)
+    # the CLI has no url option
+    thunderdrive.ThunderDriveAPI.URL = drive.url
+    os.chdir(tempfile.mkdtemp())
+    with open("config.txt", "w") as f:
+        f.write("[thunderdrive]\nusername = u\npassword = p\n")
+
+    lazy = [run(drive, argv) for argv in MODES]
+    thunderdrive.ThunderDriveAPI.__init__ = eager_init(
+        thunderdrive.ThunderDriveAPI.__init__)
+    eager = [run(drive, argv) for argv in MODES]
+    drive.close()
+
+    print("{:<40} {:>5} {:>6}".format("command", "lazy", "eager"))
+    for argv, paths, eager_paths in zip(MODES, lazy, eager):
+        print("{:<40} {:>5} {:>6}".format(" ".join(argv), len(paths),
+                                          len(eager_paths)))
+        print("    " + ", ".join(paths))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
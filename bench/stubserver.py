@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+"""local stand-in for the thunderdrive.io api, for the bench/ scripts
+
+    drive = StubDrive()
+    drive.add_files(7, 300000)
+    with ThunderDriveAPI("u", "p", url=drive.url) as thunder_cl: ...
+    print(drive.requests)
+
+Covers what ThunderDriveAPI and AsyncThunderDriveAPI use: login /
+logout, entry listings (root, folder, search, recent; paged), the folder
+list, space usage, folder creation, uploads (multipart, also chunked)
+and downloads with Range. Every request is recorded in `requests` as
+(method, path).
+"""
+
+import datetime
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # one send per response (flushed after each request): headers and
+    # body in separate packets would wait on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def drive(self):
+        return self.server.drive
+
+    def _send(self, code, body=b"", headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, obj, code=200, cookies=()):
+        headers = [("Content-Type", "application/json"),
+                   ("Set-Cookie", "XSRF-TOKEN=tok%3D1; Path=/")]
+        headers += [("Set-Cookie", c) for c in cookies]
+        self._send(code, json.dumps(obj).encode(), headers)
+
+    def _path(self):
+        url = urllib.parse.urlparse(self.path)
+        path = url.path[len("/secure/"):]
+        self.drive.record(self.command, path)
+        return path, urllib.parse.parse_qs(url.query)
+
+    def _body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        path, query = self._path()
+        drive = self.drive
+        if path == "drive/entries":
+            return self._json(drive.listing(query))
+        if re.match(r"drive/users/\d+/folders$", path):
+            return self._json({"folders": drive.folders})
+        if path == "drive/user/space-usage":
+            return self._json({"used": drive.used(), "available": 1 << 40})
+        if path == "uploads/download":
+            return self._download(drive.files[query["hashes"][0]])
+        self._json({"message": "not found"}, 404)
+
+    def _download(self, data):
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match is None:
+            return self._send(200, data)
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(data) - 1
+        self._send(206, data[start:end + 1],
+                   [("Content-Range",
+                     "bytes {}-{}/{}".format(start, end, len(data)))])
+
+    def do_POST(self):
+        path, _ = self._path()
+        body = self._body()
+        drive = self.drive
+        if path == "auth/login":
+            return self._json({"status": "success", "user": {"id": 1}},
+                              cookies=["session=1; Path=/"])
+        if path == "auth/logout":
+            return self._json({"status": "success"})
+        if path == "drive/folders":
+            data = json.loads(body)
+            folder = drive.add_folder(data["name"], data.get("parent_id"))
+            return self._json({"status": "success", "folder": folder})
+        if path == "uploads":
+            fields = self._multipart(body)
+            entry = drive.add_file(fields["filename"], fields["file"],
+                                   fields.get("parentId", b"").decode())
+            return self._json({"status": "success", "fileEntry": entry}, 201)
+        self._json({"message": "not found"}, 404)
+
+    def _multipart(self, body):
+        boundary = re.search(r"boundary=(.*)",
+                             self.headers["Content-Type"]).group(1)
+        fields = {}
+        for part in body.split(b"--" + boundary.encode()):
+            if b"\r\n\r\n" not in part:
+                continue
+            head, value = part.split(b"\r\n\r\n", 1)
+            name = re.search(rb'name="([^"]*)"', head).group(1).decode()
+            fields[name] = value[:-2]
+            file_name = re.search(rb'filename="([^"]*)"', head)
+            if file_name:
+                fields["filename"] = os.path.basename(
+                    file_name.group(1).decode())
+        return fields
+
+
+class StubDrive(object):
+    """the drive's state and the server thread answering for it"""
+
+    page_size = 50
+
+    def __init__(self, port=0):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.entries = []
+        self.folders = []
+        self.requests = []
+        self._next_id = 100
+        self._last_stamp = 0.0
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+        self.server.daemon_threads = True
+        self.server.drive = self
+        self.url = "http://127.0.0.1:{}/secure/".format(
+            self.server.server_address[1])
+        self.add_folder("Docs")
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, method, path):
+        with self.lock:
+            self.requests.append((method, path))
+
+    def _id(self):
+        with self.lock:
+            self._next_id += 1
+            return self._next_id
+
+    def _stamp(self):
+        # the time of creation (as the drive stamps uploads), distinct and
+        # increasing, like the real listing
+        with self.lock:
+            self._last_stamp = max(time.time(), self._last_stamp + 1e-6)
+            stamp = self._last_stamp
+        return datetime.datetime.fromtimestamp(
+            stamp, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    def add_folder(self, name, parent_id=None):
+        entry_id = self._id()
+        parent_id = int(parent_id) if parent_id not in (None, "") else None
+        folder = {"id": entry_id, "name": name, "hash": "f{}".format(entry_id),
+                  "parent_id": parent_id, "type": "folder", "file_size": 0,
+                  "path": str(entry_id), "created_at": self._stamp(),
+                  "users": [{"id": 1, "email": "me@example.com"}]}
+        self.folders.append(folder)
+        return folder
+
+    def add_file(self, name, data, parent_id=None):
+        entry_id = self._id()
+        parent_id = int(parent_id) if parent_id not in (None, "") else None
+        stamp = self._stamp()
+        entry = {"id": entry_id, "name": name, "hash": "h{}".format(entry_id),
+                 "parent_id": parent_id, "type": "file",
+                 "file_size": len(data), "created_at": stamp,
+                 "updated_at": stamp,
+                 "users": [{"id": 1, "email": "me@example.com"}]}
+        self.files[entry["hash"]] = data
+        self.entries.append(entry)
+        return entry
+
+    def add_files(self, count, size, parent_id=None):
+        """count files of size random bytes, named file0.bin, file1.bin..."""
+        return [self.add_file("file{}.bin".format(i), os.urandom(size),
+                              parent_id)
+                for i in range(count)]
+
+    def used(self):
+        return sum(len(data) for data in self.files.values())
+
+    def listing(self, query):
+        if "query" in query:
+            phrase = query["query"][0].lower()
+            found = [e for e in self.entries + self.folders
+                     if phrase in e["name"].lower()]
+        elif "recentOnly" in query:
+            found = sorted(self.entries, key=lambda e: e["created_at"],
+                           reverse=True)
+        else:
+            folder_id = None
+            if query.get("folderId", [""])[0]:
+                folder_id = [f["id"] for f in self.folders
+                             if f["hash"] == query["folderId"][0]][0]
+            found = [e for e in self.entries + self.folders
+                     if e["parent_id"] == folder_id]
+        page = int(query.get("page", ["1"])[0])
+        last_page = max(1, -(-len(found) // self.page_size))
+        return {"data": found[(page - 1) * self.page_size:
+                              page * self.page_size],
+                "current_page": page, "last_page": last_page,
+                "total": len(found)}
+
+    def count(self, path=None):
+        """requests so far (to path, if given)"""
+        return sum(1 for _, p in self.requests if path is None or p == path)
+
+
+if __name__ == "__main__":
+    # stubserver.py [port] [files] [file size]: serves until killed
+    args = [int(x) for x in sys.argv[1:]]
+    port, files, size = args + [0, 7, 300000][len(args):]
+    drive = StubDrive(port)
+    drive.add_files(files, size)
+    print(drive.url, flush=True)
+    threading.Event().wait()
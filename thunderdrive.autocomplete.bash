@@ -10,7 +10,7 @@ autocomplete_thunderdrive()
     prev="${COMP_WORDS[COMP_CWORD-1]}"
     #echo $prev
 
-    opts="-h --help --search --useproxy --list --prompt --interactive --uploadfile --uploadmode --downloadmode --targetdir --parentdir --createdirifnotfound --disableprogressbar --printrecent"
+    opts="-h --help --search --useproxy --list --prompt --interactive --uploadfile --uploadmode --downloadmode --targetdir --parentdir --createdirifnotfound --forceupload --disableprogressbar --printrecent --jobs --segments --cached --cachettl --offline --keepsession --countrequests --sync --syncdown --manifest --maxrate --rateschedule --stallseconds --stallratio --stallminrate --uploadtimeout --metrics --prometheus --retries --retrybudget --poolsize --benchmark --stdout --stdin --name --chunksize --disablepreallocate --jobqueue --resumejobs --find --regex --type --minsize --maxsize --after --before --reindex --feed --follow --watch --settle"
     COMPREPLY=( $(compgen -W "${opts}" -- ${cur}) )
 }
 
@@ -2,26 +2,48 @@
 # v0.20210126
 
 import requests
+import urllib3
 import sys
 import getopt
 import logging
 import urllib
 import os
+import posixpath
 import time
 import datetime
 import configparser
-import copy
-from retry.api import retry_call
-from retry import retry
+import threading
+import concurrent.futures
+import functools
+import random
+import email.utils
 
 from requests_toolbelt import (MultipartEncoder,
                                MultipartEncoderMonitor)
-# import urllib3
 # import traceback
 # import math
 # from retry import retry
 import signal
 import json
+import asyncio
+import sqlite3
+import hashlib
+import collections
+import queue
+import re
+import fnmatch
+
+try:
+    import aiohttp
+except ImportError:
+    # only AsyncThunderDriveAPI needs it
+    aiohttp = None
+
+try:
+    import inotify_simple
+except ImportError:
+    # --watch polls the directory instead
+    inotify_simple = None
 
 # # temp
 # urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -29,6 +51,14 @@ import json
 SignalStop = False
 deftimeout = 9000
 
+
+class TransferAborted(BaseException):
+    """raised inside worker threads after ctrl+C; not caught by retry"""
+
+
+class FatalError(Exception):
+    """an error trying again can not fix; RetryPolicy never retries it"""
+
 def clear():
     # clear = lambda: os.system('clear')
     return os.system('clear')
@@ -47,17 +77,201 @@ class Tools(object):
 
         return ""
 
-class ThunderDriveAPI(object):
-    """thunderdrive.io api beta"""
+    @staticmethod
+    def parse_size(value):
+        """"512K", "10M", "1.5G" or plain bytes -> bytes"""
+        value = value.strip().upper().rstrip("B")
+        units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(float(value))
+
+    @staticmethod
+    def parse_time(value):
+        """api timestamp ("2021-01-26T10:00:00.000000Z", utc) -> unix time"""
+        return datetime.datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").\
+            replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    @staticmethod
+    def parse_date(value):
+        """"2021-01-26" or "2021-01-26 10:00" (local time) -> unix time"""
+        return datetime.datetime.fromisoformat(value.strip()).timestamp()
+
+    @staticmethod
+    def format_eta(seconds):
+        """seconds left -> "42s", "7.25m", "12.5m", "150m" """
+        if seconds is None:
+            return ""
+        minutes = seconds / 60
+        if minutes >= 100:
+            return "{:.0f}m".format(minutes)
+        elif minutes >= 10:
+            return "{:.1f}m".format(minutes)
+        elif minutes >= 5:
+            return "{:.2f}m".format(minutes)
+        return "{:.0f}s".format(seconds)
+
+    @staticmethod
+    def free_name(name, taken):
+        """name, or "name (2).ext", "name (3).ext"... if taken has it
+
+        taken (a set, compared without case) gets the returned name.
+        """
+        stem, ext = os.path.splitext(name)
+        candidate, n = name, 1
+        while candidate.lower() in taken:
+            n += 1
+            candidate = "{} ({}){}".format(stem, n, ext)
+        taken.add(candidate.lower())
+        return candidate
+
+
+class RetryPolicy(object):
+    """when to try a failed operation again, and after how long
+
+    The n-th retry waits delay * backoff ** (n - 1) seconds (at most
+    max_delay), half of it randomized so parallel jobs don't come back
+    at the same moment; a Retry-After header on the error response is
+    used instead when present. Only errors retryable() accepts are
+    retried: 4xx responses, local file errors and FatalError are raised
+    at once. All operations of a client share one retry budget: each
+    retry takes a token, each success gives back budget_ratio of one and
+    every minute adds refill_per_minute, up to budget tokens. During an
+    outage the budget runs dry and the parallel jobs fail instead of
+    retrying together; a quiet long-running process (--watch, --follow)
+    still gets its retries back with time.
+    """
+
+    tries = 3
+    delay = 3.0
+    backoff = 2.0
+    max_delay = 30.0
+    budget = 20
+    budget_ratio = 0.1
+    refill_per_minute = 6.0
+    # 401/419: the session was renewed, the resend will work
+    retry_status = (401, 408, 419, 425, 429, 500, 502, 503, 504)
+
+    def __init__(self, logger, on_retry=None, **settings):
+        for key, value in settings.items():
+            if not hasattr(self, key):
+                raise TypeError("unknown retry setting '{}'".format(key))
+            setattr(self, key, value)
+        self.logger = logger
+        self.on_retry = on_retry
+        self._lock = threading.Lock()
+        self._tokens = float(self.budget)
+        self._refilled = time.monotonic()
+
+    @staticmethod
+    def _response(ex):
+        """(status, headers) of an http error response, else (None, None)"""
+        if isinstance(ex, requests.exceptions.HTTPError) and\
+                ex.response is not None:
+            return ex.response.status_code, ex.response.headers
+        if aiohttp is not None and\
+                isinstance(ex, aiohttp.ClientResponseError):
+            return ex.status, ex.headers or {}
+        return None, None
+
+    def retryable(self, ex):
+        if isinstance(ex, FatalError):
+            return False
+        status, _ = self._response(ex)
+        if status is not None:
+            return status in self.retry_status
+        if isinstance(ex, (requests.exceptions.RequestException,
+                           TransferStalled, asyncio.TimeoutError)):
+            return True
+        if aiohttp is not None and isinstance(ex, aiohttp.ClientError):
+            return True
+        if isinstance(ex, (OSError, ValueError, KeyError, TypeError)):
+            # local files, unexpected api data, bugs
+            return False
+        # short reads, SignalStop restarts, error pages
+        return True
+
+    def wait_time(self, attempt, ex):
+        """seconds to wait before retry number attempt (1, 2, ...)"""
+        _, headers = self._response(ex)
+        retry_after = headers.get("Retry-After") if headers else None
+        if retry_after is not None:
+            try:
+                return min(max(float(retry_after), 0), self.max_delay * 4)
+            except ValueError:
+                pass
+            try:
+                when = email.utils.parsedate_to_datetime(retry_after)
+                seconds = when.timestamp() - time.time()
+                return min(max(seconds, 0), self.max_delay * 4)
+            except (TypeError, ValueError):
+                pass
+        wait = min(self.delay * self.backoff ** (attempt - 1), self.max_delay)
+        return wait / 2 + random.uniform(0, wait / 2)
+
+    def _refill(self, tokens=0.0):
+        """adds tokens plus the time-based refill; call with _lock held"""
+        now = time.monotonic()
+        tokens += (now - self._refilled) * self.refill_per_minute / 60
+        self._refilled = now
+        self._tokens = min(float(self.budget), self._tokens + tokens)
+
+    def succeeded(self):
+        with self._lock:
+            self._refill(self.budget_ratio)
+
+    def should_retry(self, operation, attempt, ex, tries=None):
+        """None to give up on ex, else seconds to wait before retrying"""
+        if attempt >= (tries or self.tries) or not self.retryable(ex):
+            return None
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                self.logger.warning("{}: retry budget used up, giving up: {}".
+                                    format(operation, ex))
+                return None
+            self._tokens -= 1
+        wait = self.wait_time(attempt, ex)
+        self.logger.warning("{}: {}, retrying in {:.1f} seconds...".
+                            format(operation, ex, wait))
+        if self.on_retry is not None:
+            self.on_retry(operation, attempt + 1, ex, wait)
+        return wait
+
+    def call(self, func, args=(), kwargs=None, operation="request",
+             tries=None):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = func(*args, **(kwargs or {}))
+            except Exception as ex:
+                wait = self.should_retry(operation, attempt, ex, tries)
+                if wait is None:
+                    raise
+                time.sleep(wait)
+            else:
+                self.succeeded()
+                return result
+
+
+def retried(operation):
+    """method decorator: calls go through self.retry_policy"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            return self.retry_policy.call(method, (self,) + args, kwargs,
+                                          operation=operation)
+        return wrapper
+    return decorator
+
+
+class ThunderDriveBase(object):
+    """settings and request helpers shared by the sync and asyncio clients"""
     URL = "https://app.thunderdrive.io/secure/"
 
     errorStr = 'Whoops, looks like something went wrong.'
 
-    # temp
-    # ssl_verify = False
-    ssl_verify = True
-    proxies = None
-
     headers = dict()
     headers['User-Agent'] =\
         'Mozilla/5.0 (X11; Linux x86_64; rv:68.0) Gecko/20100101 Firefox/68.0'
@@ -67,29 +281,193 @@ class ThunderDriveAPI(object):
 
     logger = logging.getLogger(__name__)
 
+    def set_logger(self, logger):
+        self.logger = logger
+
+    def _test_resp(self, content):
+        if (str(content)).find(self.errorStr) > 0:
+            # raise Exception("wyx: " + self.errorStr)
+            raise Exception(self.errorStr)
+
+    @staticmethod
+    def _login_data(usr, psw):
+        return {"email": usr, "password": psw}
+
+    @staticmethod
+    def _xsrf_header(token):
+        """X-XSRF-TOKEN header from the (url quoted) XSRF-TOKEN cookie"""
+        return {'X-XSRF-TOKEN': urllib.parse.unquote(token)}
+
+    @staticmethod
+    def _folder_params(folder_hash="", page=None):
+        params = [('orderBy', 'name'), ('orderDir', '')]
+        if folder_hash != "":
+            params.append(('folderId', folder_hash))
+        if page is not None:
+            params.append(('page', page))
+        return params
+
+    @staticmethod
+    def _search_params(query, page=None):
+        params = [('orderBy', 'name'), ('orderDir', ''),
+                  ('type', ''), ('query', query)]
+        if page is not None:
+            params.append(('page', page))
+        return params
+
+    @staticmethod
+    def _recent_params(page=None):
+        params = [('orderBy', 'created_at'), ('orderDir', 'desc'),
+                  ('recentOnly', 'true')]
+        if page is not None:
+            params.append(('page', page))
+        return params
+
+    def get_user_id(self):
+        return self.last_resp["data"][0]["users"][0]["id"]
+
+
+class ThunderDriveAPI(ThunderDriveBase):
+    """thunderdrive.io api beta"""
+
+    # temp
+    # ssl_verify = False
+    ssl_verify = True
+    proxies = None
+
     progress_bar_len = 30
-    showprogressbar = True
-    tries = 3
+    jobs = 1
+    segments = 1
+    segment_min_size = 1024 * 1024 * 64
+    chunk_size = 1024 * 1024
+    preallocate_downloads = True
+    skip_existing = True
+    page_window = 4
+    pool_size = 0
+    pool_hosts = 4
+    stall_settings = {}
+    upload_reply_timeout = deftimeout
+    relogin_status = (401, 419)
+    default_session_file = os.path.join(os.path.expanduser("~"),
+                                        ".thunderdrive", "session.json")
 
     def __init__(self, usr, psw, logger=None,
                  https_proxy=None, http_proxy=None,
-                 ssl_verify=True):
+                 ssl_verify=True, cache=None, offline=False,
+                 session_file=None, manifest=None, metrics=None,
+                 job_queue=None, url=None):
 
         if logger is not None:
             self.set_logger(logger)
+        if url is not None:
+            self.URL = url
+        self.retry_policy = RetryPolicy(self.logger, on_retry=self._on_retry)
         self.session = requests.Session()
+        self._pool_maxsize = None
+        self._resize_pool()
+        self._post_templates = (None, {})
+        self._tls = threading.local()
+        self.abort = threading.Event()
+        self.cache = cache
+        self.manifest = manifest
+        self.metrics = metrics
+        self.job_queue = job_queue
+        self.rate_limiter = None
+        self.progress = ProgressDisplay(bar_len=self.progress_bar_len)
+        self.offline = offline
+        self.logged_in = False
+        self.session_file = session_file
+        self._credentials = (usr, psw)
+        self._relogin_lock = threading.Lock()
+        self._login_generation = 0
+        self._request_lock = threading.Lock()
+        self.request_count = 0
+        self.count_requests = False
+        # absolute paths of the downloads running now (download_file)
+        self._destinations = set()
+        self._destinations_lock = threading.Lock()
+        # fetched on first use: root listing, user id, folder list
+        self._last_resp = None
+        self._userID = None
+        self._allFolders = None
+        self._folders = None
 
         self.set_proxy(https=https_proxy, http=http_proxy)
         self.ssl_verify = ssl_verify
 
-        self._login(usr, psw)
+        if not offline and not self._restore_session():
+            self._login(usr, psw)
+            self._save_session()
 
         self.user_name = usr
 
-        self.get_folders()  # root folder
-        # get user ID
-        self.userID = self.get_user_id()
-        self.get_all_folders()
+    @property
+    def last_resp(self):
+        if self._last_resp is None:
+            self.get_folders()  # root folder
+        return self._last_resp
+
+    @last_resp.setter
+    def last_resp(self, value):
+        self._last_resp = value
+
+    @property
+    def showprogressbar(self):
+        return self.progress.enabled
+
+    @showprogressbar.setter
+    def showprogressbar(self, value):
+        self.progress.enabled = value
+
+    @property
+    def userID(self):
+        if self._userID is None:
+            self._userID = self.get_user_id()
+        return self._userID
+
+    @property
+    def allFolders(self):
+        if self._allFolders is None:
+            self.get_all_folders()
+        return self._allFolders
+
+    @property
+    def folders(self):
+        if self._folders is None:
+            self.get_all_folders()
+        return self._folders
+
+    def _count_request(self):
+        with self._request_lock:
+            self.request_count += 1
+
+    def _send(self, method, _url, **kwargs):
+        """one session request: counted, and timed for metrics"""
+        self._count_request()
+        beg = time.monotonic()
+        try:
+            resp = self.session.request(method, _url, proxies=self.proxies,
+                                        verify=self.ssl_verify, **kwargs)
+        except requests.exceptions.RequestException:
+            if self.metrics is not None:
+                self.metrics.request(method, self._url_path(_url), None,
+                                     time.monotonic() - beg)
+            raise
+        if self.metrics is not None:
+            if kwargs.get("stream"):
+                nbytes = resp.headers.get("Content-Length")
+                nbytes = int(nbytes) if nbytes is not None else None
+            else:
+                nbytes = len(resp.content)
+            self.metrics.request(method, self._url_path(_url),
+                                 resp.status_code, time.monotonic() - beg,
+                                 nbytes)
+        return resp
+
+    def _url_path(self, _url):
+        if _url.startswith(self.URL):
+            return _url[len(self.URL):]
+        return _url
 
     def __del__(self):
         # print("logout __del__")
@@ -101,22 +479,152 @@ class ThunderDriveAPI(object):
     def __exit__(self, type, value, traceback):
         # print("logout __exit__")
         self._logout()
+        if self.count_requests:
+            self.logger.info("{} requests".format(self.request_count))
+        if self.metrics is not None:
+            self.metrics.close()
 
-    @retry(tries=3, delay=3)
+    @retried("logout")
     def _logout(self):
         if self.logged_in:
+            if self.session_file is not None:
+                # keep the session alive for the next run; saved while
+                # still logged in, _save_session skips it otherwise
+                self._save_session()
+                self.logged_in = False
+                return
             self.logged_in = False
             self.post(self.URL + "auth/logout", _data=None)
 
-    @retry(tries=3, delay=3)
+    def _save_session(self):
+        """writes the cookie jar (login + XSRF-TOKEN) to session_file, 0600"""
+        if self.session_file is None or not self.logged_in:
+            return
+        cookies = [{"name": c.name, "value": c.value, "domain": c.domain,
+                    "path": c.path, "expires": c.expires, "secure": c.secure}
+                   for c in self.session.cookies]
+        os.makedirs(os.path.dirname(self.session_file) or ".", exist_ok=True)
+        tmp_name = self.session_file + ".tmp"
+        fd = os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"user": self._credentials[0], "url": self.URL,
+                       "user_id": self._userID, "cookies": cookies}, f)
+        os.replace(tmp_name, self.session_file)
+
+    def _restore_session(self):
+        """loads session_file and checks it with one request"""
+        if self.session_file is None:
+            return False
+        try:
+            with open(self.session_file) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if saved.get("user") != self._credentials[0] or\
+                saved.get("url") != self.URL:
+            return False
+        for c in saved["cookies"]:
+            self.session.cookies.set(c["name"], c["value"],
+                                     domain=c["domain"], path=c["path"],
+                                     expires=c["expires"], secure=c["secure"])
+        try:
+            resp = self._send("GET", self.URL + "drive/user/space-usage",
+                              headers=self.headers, timeout=90)
+        except requests.exceptions.RequestException as ex:
+            self.logger.info("saved session not checked: {}".format(ex))
+            return False
+        if resp.status_code != 200:
+            self.logger.info("saved session expired ({}), logging in".
+                             format(resp.status_code))
+            self.session.cookies.clear()
+            return False
+        self.logged_in = True
+        self._userID = saved.get("user_id")
+        return True
+
+    def _relogin(self, generation):
+        """new login after the server dropped the session (401/419)
+
+        generation is _login_generation from before the failed request;
+        if another thread has logged in since, its session is used.
+        """
+        with self._relogin_lock:
+            if generation != self._login_generation:
+                return
+            self.logger.info("session expired, logging in again")
+            self.session.cookies.clear()
+            self.logged_in = False
+            self._login(*self._credentials)
+            self._save_session()
+
+    @retried("login")
     def _login(self, usr, psw):
-        data = {"email": usr, "password": psw}
+        data = self._login_data(usr, psw)
         login_resp = self.post(self.URL + "auth/login", data, test_resp=True)
         if login_resp["status"] == "success":
             self.logged_in = True
-
-    def set_logger(self, logger):
-        self.logger = logger
+            self._login_generation += 1
+            user = login_resp.get("user") or {}
+            if user.get("id") is not None:
+                self._userID = user["id"]
+
+    def set_jobs(self, jobs):
+        """number of parallel transfers; grows the connection pool to match"""
+        self.jobs = max(1, int(jobs))
+        self._resize_pool()
+
+    def set_segments(self, segments):
+        """number of connections used for one large download"""
+        self.segments = max(1, int(segments))
+        self._resize_pool()
+
+    def set_pool_size(self, size):
+        """keep-alive connections per host (0: as many as jobs need)"""
+        self.pool_size = max(0, int(size))
+        self._resize_pool()
+
+    def _resize_pool(self):
+        """one adapter shared by all threads, pool_maxsize per host
+
+        Sized for every connection that can be open at once (transfers
+        times segments, plus concurrent listing pages), so no connection
+        is thrown away after use and keep-alive works for all of them.
+        Retries are left to RetryPolicy.
+        """
+        connections = self.pool_size or max(
+            self.jobs * self.segments + self.page_window,
+            requests.adapters.DEFAULT_POOLSIZE)
+        if connections == self._pool_maxsize:
+            return
+        old = self.session.get_adapter(self.URL)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_hosts, pool_maxsize=connections,
+            max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if self._pool_maxsize is not None:
+            old.close()
+        self._pool_maxsize = connections
+
+    def _post_headers(self, content_type=None):
+        """headers + X-XSRF-TOKEN, rebuilt only when the cookie changes
+
+        The returned dict is shared, callers must not change it.
+        """
+        token = self.session.cookies.get("XSRF-TOKEN")
+        cached_token, templates = self._post_templates
+        if token != cached_token:
+            templates = {}
+            self._post_templates = (token, templates)
+        headers = templates.get(content_type)
+        if headers is None:
+            headers = dict(self.headers)
+            if token is not None:
+                headers.update(self._xsrf_header(token))
+            if content_type is not None:
+                headers["Content-Type"] = content_type
+            templates[content_type] = headers
+        return headers
 
     def set_proxy(self, https=None, http=None):
         self.proxies = {}
@@ -131,18 +639,24 @@ class ThunderDriveAPI(object):
 
     def get(self, _url, stream=None, params=None, test_resp=False,
             convert_to_json=True,
-            timeout=90):
+            timeout=90, headers=None):
 
-        resp = self.session.get(_url, proxies=self.proxies,
-                                verify=self.ssl_verify, stream=stream,
-                                headers=self.headers, params=params,
-                                timeout=timeout)
+        if headers is not None:
+            headers = dict(self.headers, **headers)
+        else:
+            headers = self.headers
+        generation = self._login_generation
+        resp = self._send("GET", _url, stream=stream, headers=headers,
+                          params=params, timeout=timeout)
+        if resp.status_code in self.relogin_status and self.logged_in:
+            resp.close()
+            self._relogin(generation)
+            resp = self._send("GET", _url, stream=stream, headers=headers,
+                              params=params, timeout=timeout)
         resp.raise_for_status()
 
         if test_resp:
-            if (str(resp.content)).find(self.errorStr) > 0:
-                # raise Exception("wyx: " + self.errorStr)
-                raise Exception(self.errorStr)
+            self._test_resp(resp.content)
 
         if convert_to_json:
             return resp.json()
@@ -150,210 +664,365 @@ class ThunderDriveAPI(object):
             return resp
 
     def post(self, _url, _data, _json=None, test_resp=False,
-             headers=headers, auth=None, convert_to_json=True,
+             headers=None, auth=None, convert_to_json=True,
              timeout=90):
 
-        resp = self.session.post(_url, data=_data, json=_json, proxies=self.proxies,
-                                 verify=self.ssl_verify,
-                                 headers=headers, auth=auth,
-                                 timeout=timeout)
+        if headers is None:
+            headers = self.headers
+        generation = self._login_generation
+        resp = self._send("POST", _url, data=_data, json=_json,
+                          headers=headers, auth=auth, timeout=timeout)
+        if resp.status_code in self.relogin_status and self.logged_in and\
+                not _url.endswith("auth/logout"):
+            # the body may be a consumed stream and the XSRF header is
+            # stale: log in again and let the caller's retry resend it
+            self._relogin(generation)
         resp.raise_for_status()
         # print(resp.text)
 
         if test_resp:
-            if (str(resp.content)).find(self.errorStr) > 0:
-                # raise Exception("wyx: " + self.errorStr)
-                raise Exception(self.errorStr)
+            self._test_resp(resp.content)
         if convert_to_json:
             return resp.json()
         else:
             return resp
 
-    @retry(tries=3, delay=3)
+    def _cache_key(self, key):
+        """key of the metadata cache for this account and api url"""
+        return "{} {} {}".format(self._credentials[0], self.URL, key)
+
+    def _cached(self, key, fetch):
+        """listing from the metadata cache, or fetch() and remember it"""
+        if self.cache is not None:
+            payload = self.cache.get(self._cache_key(key),
+                                     ignore_ttl=self.offline)
+            if payload is not None:
+                return payload
+        if self.offline:
+            raise FatalError("offline: '{}' is not in the metadata cache".
+                            format(key))
+        payload = fetch()
+        if self.cache is not None:
+            self.cache.put(self._cache_key(key), payload)
+        return payload
+
+    def _invalidate_folder(self, folder_hash=""):
+        """drops cached listings that a change in this folder makes stale"""
+        if self.cache is not None:
+            self.cache.invalidate(self._cache_key("folder:" + folder_hash),
+                                  prefix=self._cache_key("search:"))
+
+    @retried("listing")
     def get_folders(self, folder_hash=""):
         params = None
         if folder_hash != "":
-            params = [('orderBy', 'name'),
-                      ('orderDir', ''),
-                      ('folderId', folder_hash)]
-        self.last_resp = self.get(self.URL + "drive/entries", params=params)
-
-    def get_user_id(self):
-        return self.last_resp["data"][0]["users"][0]["id"]
-
-    @retry(tries=3, delay=3)
+            params = self._folder_params(folder_hash)
+        self.last_resp = self._cached(
+            "folder:" + folder_hash,
+            lambda: self.get(self.URL + "drive/entries", params=params))
+
+    def get_folder_entries(self, folder_hash=""):
+        """all entries of one folder (root if no hash), every page"""
+        entries = []
+        for _, data in self._iter_entry_pages(
+                lambda page: self._folder_params(folder_hash, page)):
+            entries.extend(data)
+        return entries
+
+    @retried("listing")
     def get_all_folders(self):
-        self.allFolders = self.get(self.URL + "drive/users/{}/folders".
-                                   format(self.userID))["folders"]
-        return self.allFolders
-
-    @retry(tries=3, delay=3)
+        self._allFolders = self._cached(
+            "folders",
+            lambda: self.get(self.URL + "drive/users/{}/folders".
+                             format(self.userID)))["folders"]
+        self._folders = FolderIndex(self._allFolders)
+        return self._allFolders
+
+    @retried("space usage")
     def get_space_usage(self):
         resp = self.get(self.URL + "drive/user/space-usage")
         return resp["used"], resp["available"]
 
-    def _print_progress_bar(self, iteration, total, prefix='', suffix='',
-                            decimals=1, length=100, fill='█', printEnd="\r"):
+    def benchmark_listing(self, count=100, jobs=None):
+        """count uncached root listings, jobs at a time -> requests/s
+
+        For comparing pool sizes and job counts (--benchmark); with url=
+        pointing at a local server (bench/listing.py) it measures the
+        client alone.
         """
-        Call in a loop to create terminal progress bar
-        @params:
-            iteration - Req.: current iteration (Int)
-            total     - Req.: total iterations (Int)
-            prefix    - Opt.: prefix string (Str)
-            suffix    - Opt.: suffix string (Str)
-            decimals  - Opt.: posit. num. of decimals in percent complete (Int)
-            length    - Opt.: character length of bar (Int)
-            fill      - Opt.: bar fill character (Str)
-            printEnd  - Opt.: end character (e.g. "\r", "\r\n") (Str)
+        jobs = max(1, int(jobs or self.jobs))
+        before = self.request_count
+        beg = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as ex:
+            list(ex.map(lambda _: self._get_entries_page(
+                self._folder_params()), range(count)))
+        elapsed = max(time.monotonic() - beg, 0.001)
+        rate = (self.request_count - before) / elapsed
+        self.logger.info("benchmark: {} listings, {} jobs, pool {}: {:.0f}s, "
+                         "{:.1f} requests/s".format(count, jobs,
+                                                    self._pool_maxsize,
+                                                    elapsed, rate))
+        return rate
+
+    def _transfer_state(self):
+        """stall / progress state of the transfer running in this thread"""
+        st = self._tls
+        if not hasattr(st, "upload_sent"):
+            st.stall = None
+            st.progress = None
+            st.upload_sent = 0
+        return st
+
+    def _start_stall_detector(self, name):
+        """new StallDetector for the transfer starting in this thread"""
+        rate_cap = None
+        if self.rate_limiter is not None:
+            # a throttled transfer is slow on purpose: judge it against its
+            # share of the limit, not against an unthrottled peak
+            connections = self.jobs * self.segments
+            rate_cap = lambda: self.rate_limiter.current_rate() / connections
+        st = self._transfer_state()
+        st.stall = StallDetector(name, self.logger, rate_cap=rate_cap,
+                                 **self.stall_settings)
+        return st.stall
+
+    def _transfer_timeout(self, upload=False):
+        """(connect, read) timeout of a transfer request
+
+        The read timeout is the wait for the response: a server may take
+        long to start sending a file, and it answers an upload only once
+        it has the whole file (upload_reply_timeout). Body reads get a
+        short one, see _read_chunks.
         """
+        return (90, self.upload_reply_timeout if upload else deftimeout)
 
-        if not self.showprogressbar:
-            return
-
-        percent = ("{0:." + str(decimals) + "f}").\
-            format(100 * (iteration / float(total)))
-        filled_length = int(length * iteration // total)
-        bar = fill * filled_length + '-' * (length - filled_length)
-
-        print('\r%s |%s| %s%% %s' % (prefix, bar, percent, suffix),
-              end=printEnd)
-        # # Print New Line on Complete
-        # if iteration == total:
-        #     print()
-
-    __prevTime = None
-    __prevChunk = None
-    __beg_time = None
-
-    def _get_up_down_speed(self, chC=0, total=None, init=False):
-        speed = None
-
-        if self.__prevChunk is None or init:
-            self.__prevChunk = chC
-        if self.__prevTime is None or init:
-            self.__prevTime = time.time()
-        if self.__beg_time is None or init:
-            self.__beg_time = datetime.datetime.now()
-
-        dTime = round(float(time.time() - self.__prevTime), 3)
-        dChunk = chC - self.__prevChunk
-
-        if dTime != 0:
-            speed = int(dChunk / dTime)
-
-        ttl_str = ""
-        if total is not None and self.__beg_time is not None:
-            seconds = (datetime.datetime.now() - self.__beg_time).\
-                total_seconds()
-            ttl = seconds / chC * (total - chC)
-            if (ttl / 60 >= 100):
-                ttl_str = " " + "{:.0f}".format(round(ttl / 60, 0)) + "m"
-            elif (ttl / 60 >= 10):
-                ttl_str = " " + "{:.1f}".format(round(ttl / 60, 1)) + "m"
-            elif (ttl / 60 >= 5):
-                ttl_str = " " + "{:.2f}".format(round(ttl / 60, 2)) + "m"
-            else:
-                ttl_str = " " + "{:.0f}".format(round(ttl, 0)) + "s"
-            # ttl_str = " " + str(ttl)
-            # ttl_str = '{} {} {}'.format(seconds, chC, total)
-            # print('{} {} {} {}'.format(seconds, chC, total, round(ttl, 2)))
-
-        self.__prevTime = time.time()
-        self.__prevChunk = chC
-
-        avg = self.calculateSpeddAVG(speed)
+    def _stall_timeout(self):
+        """seconds a body read may wait for data: the stall detector's grace
 
-        retSpeed = Tools.sizeof_fmt(speed) + ttl_str + " " * 10
-        return retSpeed[0:7 + 6] + avg
-
-    def download_file_with_retry(self, file_info):
-        retry_call(self.download_file, fargs=[file_info], tries=self.tries,
-                   delay=5, backoff=2, max_delay=30, logger=self.logger)
+        A connection that sends nothing makes no progress the detector
+        could judge, so the read timeout has to end it.
+        """
+        return self.stall_settings.get("grace", StallDetector.grace) +\
+            self.stall_settings.get("window", StallDetector.window)
+
+    def _on_retry(self, operation, attempt, ex, wait):
+        if self.metrics is not None:
+            self.metrics.retry(operation, attempt, ex, wait)
+
+    def _finish_transfer(self, progress, direction):
+        self.progress.finish(progress)
+        if self.metrics is not None:
+            self.metrics.transfer(direction, progress.name,
+                                  progress.done - progress.initial,
+                                  time.monotonic() - progress.start,
+                                  progress.complete,
+                                  time.process_time() - progress.cpu_start)
+
+    def _read_chunks(self, r):
+        """the (decoded) response body in chunks of up to chunk_size bytes
+
+        Every read returns what has arrived, so abort / stall / progress
+        checks keep running on slow links and a timeout loses nothing
+        that was received. Reads time out after _stall_timeout().
+        """
+        conn = r.raw.connection
+        sock = conn.sock if conn is not None else None
+        if sock is not None:
+            # headers are in: from here on silence means a stall (urllib3
+            # sets the read timeout again for the connection's next answer)
+            sock.settimeout(self._stall_timeout())
+        # urllib3 1.x has no read1; its read waits for the whole chunk
+        read = getattr(r.raw, "read1", r.raw.read)
+        try:
+            while True:
+                chunk = read(self.chunk_size, decode_content=True)
+                if not chunk:
+                    return
+                yield chunk
+        except urllib3.exceptions.ReadTimeoutError as ex:
+            self.logger.info("stall: no data from '{}', restarting".
+                             format(self._url_path(r.url)))
+            raise TransferStalled("no data: {}".format(ex))
+
+    def download_file_with_retry(self, file_info, file_name=None):
+        self.retry_policy.call(self.download_file, (file_info, file_name),
+                               operation="download")
 
-    @retry(tries=3, delay=3)
     def make_folder(self, name, parent_name):
-        pid = None
+        parent = None
         if parent_name != "":
-            pid, _ = self.find_folder_id(tdir = parent_name)
-        
-        data = json.dumps({"name": name, "parent_id": pid})
-
-        headersupl = dict()
-        headersupl = copy.deepcopy(self.headers)
-        headersupl['X-XSRF-TOKEN'] =\
-            urllib.parse.unquote(self.session.cookies["XSRF-TOKEN"])
-        headersupl["Content-Type"] = "application/json"
+            _, parent_hash = self.find_folder_id(tdir = parent_name)
+            parent = self.folders.by_hash.get(parent_hash)
+        # the folder's own (int) id, as _make_path passes it: the string
+        # from find_folder_id would miss the by_id lookup in _create_folder
+        folder = self._create_folder(
+            name, parent["id"] if parent is not None else None)
+        if folder is None:
+            return "", ""
+        self.logger.info("Folder '{}' created in {} directory".
+                         format(name, parent_name))
+        return str(folder["id"]), folder["hash"]
+
+    @retried("create folder")
+    def _create_folder(self, name, parent_id=None):
+        """creates one folder and adds it to the folder index"""
+        data = json.dumps({"name": name, "parent_id": parent_id})
 
         mk_resp = self.post(self.URL + "drive/folders", _data=data,
-                            test_resp=True, headers=headersupl)
+                            test_resp=True,
+                            headers=self._post_headers("application/json"))
         # mk_resp = self.post("http://httpbin.org/post", _data=data, test_resp=True)
 
-        if mk_resp["status"] == "success":
-            self.logger.info("Folder '{}' created in {} directory".
-                    format(name, parent_name))
-            self.get_all_folders()
-            return self.find_folder_id(tdir = name)
-        
-        return "", ""
+        if mk_resp["status"] != "success":
+            return None
+        if self.cache is not None:
+            self.cache.invalidate(self._cache_key("folders"),
+                                  prefix=self._cache_key("folder:"))
+            self.cache.invalidate(prefix=self._cache_key("search:"))
+
+        folder = mk_resp.get("folder")
+        if folder is not None:
+            self.allFolders.append(folder)
+            self.folders.add(folder)
+            return folder
+        # older api answers without the new folder: reload the tree
+        self.get_all_folders()
+        parent = self.folders.by_id.get(parent_id)
+        return self.folders.child(parent, name)
 
     def find_folder_id(self, tdir, parent_folder = "", allow_create = False):
-        for folder in self.allFolders:
-            if folder["name"].upper() == tdir.upper():
-                self.logger.info("Found dir '{}': id - {}; hash - {}".
-                                 format(tdir, folder["id"], folder["hash"]))
-                return str(folder["id"]), folder["hash"]
+        """id and hash of folder tdir, a name or an "a/b/c" path
+
+        A plain name matches the first folder of that name anywhere, a path
+        is resolved from the root, and with parent_folder both are resolved
+        inside that folder. allow_create makes missing folders (mkdir -p).
+        """
+        parent = None
+        if parent_folder != "":
+            parent = self.folders.lookup(parent_folder)
+            if parent is None and allow_create:
+                parent = self._make_path(parent_folder)
+            if parent is None:
+                self.logger.info("Directory '{}' not found in ThunderDrive.io".
+                                 format(parent_folder))
+                return "", ""
+
+        folder = self.folders.lookup(tdir, parent)
+        if folder is not None:
+            self.logger.info("Found dir '{}': id - {}; hash - {}".
+                             format(tdir, folder["id"], folder["hash"]))
+            return str(folder["id"]), folder["hash"]
 
         if allow_create:
-            xid, xhash = self.make_folder(tdir, parent_folder)
-            if xid != 0:
-                return str(xid), xhash
+            folder = self._make_path(tdir, parent)
+            if folder is not None:
+                self.logger.info("Folder '{}' created: id - {}; hash - {}".
+                                 format(tdir, folder["id"], folder["hash"]))
+                return str(folder["id"]), folder["hash"]
 
         self.logger.info("Directory '{}' not found in ThunderDrive.io".
                          format(tdir))
         return "", ""
 
-    def upload_file_with_retry(self, file_paths, folder_id="", folder_hash=""):
+    def _make_path(self, path, parent=None):
+        """creates the missing folders of path under parent (or root)"""
+        for name in FolderIndex.split(path):
+            folder = self.folders.child(parent, name)
+            if folder is None:
+                folder = self._create_folder(
+                    name, parent["id"] if parent is not None else None)
+                if folder is None:
+                    return None
+            parent = folder
+        return parent
+
+    def upload_file_with_retry(self, file_paths, folder_id="", folder_hash="",
+                               jobs=None):
+        file_paths = self._skip_uploaded(file_paths, folder_hash)
+        return self._run_jobs("upload", [{"path": path,
+                                          "folder_id": folder_id,
+                                          "folder_hash": folder_hash}
+                                         for path in file_paths], jobs)
+
+    def upload_one_with_retry(self, filePath, folder_id="", folder_hash=""):
+        self.retry_policy.call(self.upload_file, (filePath,),
+                               {"folder_id": folder_id,
+                                "folder_hash": folder_hash},
+                               operation="upload")
+
+    def _skip_uploaded(self, file_paths, folder_hash):
+        """drops files the target folder already has
+
+        Known from the manifest (same content uploaded there before) or
+        listed in the folder with the same name and size.
+        """
+        if not self.skip_existing:
+            return list(file_paths)
+        file_paths = list(file_paths)
+        if self.manifest is not None:
+            todo = []
+            for filePath in file_paths:
+                if self.manifest.is_uploaded(filePath, folder_hash):
+                    self.logger.info("skipping '{}': already uploaded "
+                                     "(manifest)".format(filePath))
+                else:
+                    todo.append(filePath)
+            file_paths = todo
+        if not file_paths:
+            return file_paths
+
+        existing = {}
+        for entry in self.get_folder_entries(folder_hash):
+            if entry["type"] != "folder":
+                existing[entry["name"]] = entry["file_size"]
+        todo = []
         for filePath in file_paths:
-            retry_call(self.upload_file, fargs=[filePath],
-                       fkwargs={"folder_id": folder_id,
-                       "folder_hash": folder_hash}, tries=self.tries,
-                       delay=5, backoff=2, max_delay=30, logger=self.logger)
-
-    __upload_step = 0
+            name = os.path.basename(filePath)
+            if existing.get(name) == os.path.getsize(filePath):
+                self.logger.info("skipping '{}': already uploaded".
+                                 format(filePath))
+            else:
+                todo.append(filePath)
+        return todo
 
     def __upload_callback(self, encoder):
         """Upload progress bar."""
-        self.__upload_step += 1
+        st = self._transfer_state()
+        sent = encoder.bytes_read - st.upload_sent
+        st.upload_sent = encoder.bytes_read
+        self._account_chunk(sent, st.progress.name, st.stall, st.progress,
+                            upload=True)
+
+    def _account_chunk(self, n, name, stall=None, progress=None,
+                       upload=False):
+        """after every chunk of a transfer: abort / SignalStop checks, rate
+        limit, stall detector and progress (n bytes)"""
         global SignalStop
+        if self.abort.is_set():
+            raise TransferAborted(name)
         if SignalStop:
             SignalStop = False
-            raise Exception("SignalStop upld")
-        if self.__upload_step % 200 != 0:
-            return
-
-        fraction = encoder.bytes_read / encoder.len * 100
-        speed = self._get_up_down_speed(chC=encoder.bytes_read,
-                                        total=encoder.len)
-        self._print_progress_bar(fraction, 100.01,
-                                 length=self.progress_bar_len, prefix='P: ',
-                                 suffix=speed)
+            raise Exception("SignalStop " + ("upld" if upload else "dnld"))
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(n)
+        if stall is not None:
+            stall.update(n)
+        if progress is not None:
+            progress.update(n)
 
     def __rewrite_request(self, prepared_request):
         return prepared_request
 
     def upload_file(self, filePath, folder_id="", folder_hash=""):
         print_pid()
-        headersupl = dict()
-        headersupl = copy.deepcopy(self.headers)
-        headersupl['X-XSRF-TOKEN'] =\
-            urllib.parse.unquote(self.session.cookies["XSRF-TOKEN"])
+        headersupl = dict(self._post_headers())
         # headersupl['Origin'] = "https://app.thunderdrive.io"
 
         with open(filePath, 'rb') as f:
             # with sys.stdin as f:
             form = MultipartEncoder({
                 'parentId': (None, folder_id),
-                'file': (filePath, f),
+                'file': (os.path.basename(filePath), f),
             })
             monitor =\
                 MultipartEncoderMonitor(form, callback=self.__upload_callback)
@@ -365,20 +1034,24 @@ class ThunderDriveAPI(object):
                                     datetime.datetime.now().
                                     strftime('%H:%M:%S')))
 
-            self._print_progress_bar(0, 100, length=self.progress_bar_len,
-                                     prefix='P: ')
-            self._get_up_down_speed(init=True)
+            st = self._transfer_state()
+            st.upload_sent = 0
+            self._start_stall_detector(filePath)
+            st.progress = self.progress.start(filePath, monitor.len)
 
             # r =
             # self.post(self.URL + "uploads", monitor, headers=headersupl,
             #   auth=self.__rewrite_request, convert_to_json=False)
-            self.post(self.URL + "uploads", monitor, headers=headersupl,
-                      convert_to_json=False, timeout=deftimeout)
-            self._print_progress_bar(100, 100, length=self.progress_bar_len,
-                                     prefix='P: ', suffix=" " * 13)
-            if self.showprogressbar:
-                print()
+            try:
+                self.post(self.URL + "uploads", monitor, headers=headersupl,
+                          convert_to_json=False,
+                          timeout=self._transfer_timeout(upload=True))
+            finally:
+                self._finish_transfer(st.progress, "upload")
 
+        self._invalidate_folder(folder_hash)
+        if self.manifest is not None:
+            self.manifest.record_upload(filePath, folder_hash)
         # print()
         # self.logger.info(r)
         # r.raise_for_status()
@@ -387,150 +1060,2316 @@ class ThunderDriveAPI(object):
                                 strftime('%H:%M:%S')))
         # self.logger.info("done")
 
-    def download_file(self, file_info):
+    def upload_stream(self, stream, name, folder_id="", folder_hash=""):
+        """uploads a binary stream of unknown length as file name
+
+        The multipart body is generated while stream (e.g.
+        sys.stdin.buffer) is read and goes out with chunked transfer
+        encoding, nothing is staged on disk. A stream can't be read twice,
+        so this is not retried.
+        """
+        boundary = os.urandom(16).hex()
+        headers = dict(self._post_headers(),
+                       **{"Content-Type": "multipart/form-data; boundary=" +
+                          boundary})
+        self.logger.info("B: uploading stream as '{}' {}".
+                         format(name, datetime.datetime.now().
+                                strftime('%H:%M:%S')))
+        stall = self._start_stall_detector(name)
+        progress = self.progress.start(name, None)
+        body = self._multipart_body([("parentId", folder_id)], name, stream,
+                                    boundary, stall, progress)
+        try:
+            self.post(self.URL + "uploads", body, headers=headers,
+                      convert_to_json=False,
+                      timeout=self._transfer_timeout(upload=True))
+        finally:
+            self._finish_transfer(progress, "upload")
+        self._invalidate_folder(folder_hash)
+        self.logger.info("E: uploading done '{}' ({}) {}".
+                         format(name, Tools.sizeof_fmt(progress.done),
+                                datetime.datetime.now().
+                                strftime('%H:%M:%S')))
+
+    def _multipart_body(self, fields, name, stream, boundary, stall,
+                        progress):
+        """multipart/form-data body, yielded chunk by chunk"""
+        for key, value in fields:
+            yield ('--{}\r\nContent-Disposition: form-data; name="{}"'
+                   '\r\n\r\n{}\r\n'.format(boundary, key, value)).encode()
+        yield ('--{}\r\nContent-Disposition: form-data; name="file"; '
+               'filename="{}"\r\nContent-Type: application/octet-stream'
+               '\r\n\r\n'.format(boundary, name.replace('"', '%22'))).encode()
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                break
+            self._account_chunk(len(chunk), name, stall, progress,
+                                upload=True)
+            yield chunk
+        progress.total = progress.done
+        yield "\r\n--{}--\r\n".format(boundary).encode()
+
+    def download_file(self, file_info, file_name=None):
+        """downloads to file_name (default: the entry name in cwd)"""
+        file_size = int(file_info["file_size"])
+        file_name = file_name or file_info["name"]
+        if self.manifest is not None and os.path.isfile(file_name) and\
+                os.path.getsize(file_name) == file_size:
+            self.logger.info("skipping '{}': local copy has the same size".
+                             format(file_name))
+            return
+        # two jobs on one file would mix their bytes in the same .part
+        dest = os.path.abspath(file_name)
+        with self._destinations_lock:
+            if dest in self._destinations:
+                raise FatalError("'{}' is already being downloaded by "
+                                 "another job".format(file_name))
+            self._destinations.add(dest)
+        try:
+            if self.segments > 1 and file_size >= self.segment_min_size:
+                if self._download_segmented(file_info, file_name):
+                    return
+            self._download_stream(file_info, file_name)
+        finally:
+            with self._destinations_lock:
+                self._destinations.discard(dest)
+
+    def download_to_stream(self, file_info, out):
+        """writes the file to a binary stream (e.g. sys.stdout.buffer)
+
+        No .part file: a retry continues with a Range request after the
+        bytes already written, or fails if the server ignores Range.
+        """
+        written = [0]
+        self.retry_policy.call(self._download_to_stream,
+                               (file_info, out, written),
+                               operation="download")
+
+    def _download_to_stream(self, file_info, out, written):
+        file_size = int(file_info["file_size"])
+        name = file_info["name"]
+        offset = written[0]
+        self.logger.info("B: " + name + " -> stream " + datetime.datetime.
+                         now().strftime('%H:%M:%S') + " ("
+                         + Tools.sizeof_fmt(file_size) + ")")
+        range_headers = None
+        if offset > 0:
+            range_headers = {"Range": "bytes={}-".format(offset)}
+        r = self.get(self.URL + "uploads/download",
+                     params=[('hashes', file_info["hash"])],
+                     convert_to_json=False, stream=True,
+                     timeout=self._transfer_timeout(),
+                     headers=range_headers)
+        if offset > 0 and r.status_code != 206:
+            r.close()
+            raise FatalError("{}: no range support, can't resume the "
+                             "stream at {}".format(name, offset))
+
+        stall = self._start_stall_detector(name)
+        progress = self.progress.start(name, file_size, done=offset)
+        try:
+            for ch in self._read_chunks(r):
+                out.write(ch)
+                written[0] += len(ch)
+                self._account_chunk(len(ch), name, stall, progress)
+        finally:
+            r.close()
+            self._finish_transfer(progress, "download")
+        out.flush()
+        if written[0] != file_size:
+            raise Exception("{}: got {} of {} bytes".format(name, written[0],
+                                                           file_size))
+        self.logger.info("E: " + name + " " + datetime.datetime.now().
+                         strftime('%H:%M:%S'))
+
+    def _download_stream(self, file_info, file_name):
 
         print_pid()
         file_size = int(file_info["file_size"])
-        file_name = file_info["name"]
+        part = PartialDownload(file_name, file_info)
+        offset = part.load()
 
         self.logger.info("B: " + file_name + " "
                          + datetime.datetime.now().strftime('%H:%M:%S') + " ("
                          + Tools.sizeof_fmt(file_size) + ")")
+        if offset > 0 and offset >= file_size:
+            part.finish()
+            self.logger.info("E: " + file_name + " (already complete)")
+            return
 
+        range_headers = None
+        if offset > 0:
+            range_headers = {"Range": "bytes={}-".format(offset)}
         r = self.get(self.URL + "uploads/download",
                      params=[('hashes', file_info["hash"])],
                      convert_to_json=False, stream=True,
-                     timeout=deftimeout)
+                     timeout=self._transfer_timeout(),
+                     headers=range_headers)
+        if offset > 0:
+            if r.status_code == 206:
+                self.logger.info("R: " + file_name + " resuming at "
+                                 + Tools.sizeof_fmt(offset))
+            else:
+                self.logger.info("R: " + file_name + " no range support, "
+                                 "restarting from 0")
+                offset = 0
 
         self.logger.info("D: " + file_name + " " + datetime.datetime.now().
                          strftime('%H:%M:%S'))
-        self._print_progress_bar(0, 100, length=self.progress_bar_len,
-                                 prefix='P: ')
-        i = 0
-        chC = 0
-        chunk_size = 1024 * 512
-        global SignalStop
-        self._get_up_down_speed(init=True)
-        with open(file_name, 'wb') as f:
-            for ch in r.iter_content(chunk_size=chunk_size):
-                if SignalStop:
-                    SignalStop = False
-                    raise Exception("SignalStop dnld")
-                f.write(ch)
-                i += 1
-                chC += chunk_size
-                if i % 5 == 0:
-                    # print (i, chC / file_size * 100)
-                    speed = self._get_up_down_speed(chC=chC, total=file_size)
-                    self._print_progress_bar(chC / file_size * 100, 100,
-                                             length=self.progress_bar_len,
-                                             prefix='P: ', suffix=speed)
-
-                # time.sleep(0.1)
-            self._print_progress_bar(100, 100, length=self.progress_bar_len,
-                                     prefix='P: ', suffix=" " * 13)
-            if self.showprogressbar:
-                print()
+        chC = offset
+        stall = self._start_stall_detector(file_name)
+        progress = self.progress.start(file_name, file_size, done=offset)
+        with part.open(offset, file_size if self.preallocate_downloads
+                       else None) as f:
+            try:
+                for ch in self._read_chunks(r):
+                    f.write(ch)
+                    chC += len(ch)
+                    self._account_chunk(len(ch), file_name, stall, progress)
+                    if part.due():
+                        part.commit(f, chC)
+            finally:
+                if chC != file_size:
+                    # keep what reached the disk for the next try
+                    part.commit(f, chC)
+                self._finish_transfer(progress, "download")
 
         r.close()
         r.raise_for_status()
+        if chC != file_size:
+            raise Exception("{}: got {} of {} bytes".format(file_name, chC,
+                                                           file_size))
+        part.finish()
         self.logger.info("E: " + file_name + " " + datetime.datetime.now().
                          strftime('%H:%M:%S'))
 
-    @retry(tries=3, delay=3)
-    def get_recent(self, all = False, count = 0):
-        # self.logger.info("recent ({}) .....".format(""))
-        params = [('orderBy', 'created_at'), ('orderDir', 'desc'),
-                  ('recentOnly', 'true')]
-        resp = self.get(self.URL + "drive/entries", params=params)
-        self.last_resp = resp
-        # self.last_resp["data"].clear()
-
-        # for x in resp["data"]:
-        #     self.last_resp["data"].append(x)
-        #     if len(self.last_resp["data"]) >= count:
-        #         stop = True
-        #         break
-
-        while len(self.last_resp["data"]) > count:
-            del(self.last_resp["data"][count])
-        if len(self.last_resp["data"]) >= count:
-            return self.last_resp
-        
-        if all:
-            count = 99999
-
-        page = 1
-        stop = False
-        if all or count > 0:
-            while page <= int(resp["last_page"]):
-                page += 1
-                params = [('orderBy', 'created_at'), ('orderDir', 'desc'),
-                  ('recentOnly', 'true'), ('page', page)]
-                resp = self.get(self.URL + "drive/entries", params=params)
-
-                for x in resp["data"]:
-                    self.last_resp["data"].append(x)
-                    if len(self.last_resp["data"]) >= count:
-                        stop = True
-                        break
-
-                # print(len(self.last_resp["data"]))
-                if stop:
+    def _download_segmented(self, file_info, file_name):
+        """download one file over several Range requests at once
+
+        Returns False (without downloading) when the server ignores Range.
+        """
+        print_pid()
+        file_size = int(file_info["file_size"])
+        part = PartialDownload(file_name, file_info)
+        segments = part.load_segments(self.segments)
+        todo = [i for i, seg in enumerate(segments) if seg[2] < seg[1]]
+        received = [seg[2] - seg[0] for seg in segments]
+
+        self.logger.info("B: " + file_name + " "
+                         + datetime.datetime.now().strftime('%H:%M:%S') + " ("
+                         + Tools.sizeof_fmt(file_size) + ", "
+                         + str(len(todo)) + "/" + str(len(segments))
+                         + " segments)")
+        first = None
+        if todo:
+            first = self._get_segment(file_info, segments[todo[0]])
+            if first.status_code != 206:
+                first.close()
+                part.discard()
+                self.logger.info("R: " + file_name + " no range support, "
+                                 "single stream download")
+                return False
+
+        self.logger.info("D: " + file_name + " " + datetime.datetime.now().
+                         strftime('%H:%M:%S'))
+        stop = threading.Event()
+        start_bytes = sum(received)
+        stall = self._start_stall_detector(file_name)
+        progress = self.progress.start(file_name, file_size, done=start_bytes)
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, len(todo)))
+        futures = [executor.submit(self._download_segment, file_info, part,
+                                   i, first if n == 0 else None, received,
+                                   stop)
+                   for n, i in enumerate(todo)]
+        chC = start_bytes
+        try:
+            pending = futures
+            while pending:
+                _, pending = concurrent.futures.wait(
+                    pending, timeout=1,
+                    return_when=concurrent.futures.FIRST_EXCEPTION)
+                if any(f.done() and f.exception() for f in futures):
+                    break
+                prev, chC = chC, sum(received)
+                stall.update(chC - prev)
+                progress.update(chC - prev)
+        finally:
+            stop.set()
+            executor.shutdown(wait=True)
+            progress.update(sum(received) - chC)
+            self._finish_transfer(progress, "download")
+        for f in futures:
+            f.result()
+        if not part.complete():
+            raise Exception("{}: segments incomplete, {} of {} bytes".
+                            format(file_name, sum(received), file_size))
+        part.finish()
+        self.logger.info("E: " + file_name + " " + datetime.datetime.now().
+                         strftime('%H:%M:%S'))
+        return True
+
+    def _get_segment(self, file_info, segment):
+        _, end, pos = segment
+        return self.get(self.URL + "uploads/download",
+                        params=[('hashes', file_info["hash"])],
+                        convert_to_json=False, stream=True,
+                        timeout=self._transfer_timeout(),
+                        headers={"Range": "bytes={}-{}".format(pos, end - 1)})
+
+    def _download_segment(self, file_info, part, index, r, received, stop):
+        start, end, pos = part.segments[index]
+        if r is None:
+            r = self._get_segment(file_info, part.segments[index])
+            if r.status_code != 206:
+                r.close()
+                raise Exception("segment {}: range request ignored".
+                                format(index))
+        committed_at = time.monotonic()
+        fd = os.open(part.part_name, os.O_WRONLY)
+        try:
+            for ch in self._read_chunks(r):
+                if stop.is_set():
+                    break
+                ch = ch[:end - pos]
+                os.pwrite(fd, ch, pos)
+                pos += len(ch)
+                received[index] = pos - start
+                # the segments' stall / progress are summed up by
+                # _download_segmented
+                self._account_chunk(len(ch), file_info["name"])
+                if part.due(committed_at):
+                    part.commit_segment(fd, index, pos)
+                    committed_at = time.monotonic()
+                if pos >= end:
                     break
+        finally:
+            part.commit_segment(fd, index, pos)
+            os.close(fd)
+            r.close()
+        r.raise_for_status()
+        if pos < end and not stop.is_set():
+            raise Exception("segment {}: got {} of {} bytes".
+                            format(index, pos - start, end - start))
+
+    @retried("listing")
+    def _get_entries_page(self, params, timeout=90):
+        return self.get(self.URL + "drive/entries", params=params,
+                        timeout=timeout)
 
-                # self.last_resp["data"].append()
-                # //self.last_resp["data"].ap
-            # print(len(self.last_resp["data"]))
+    def _iter_entry_pages(self, params_for_page, limit=None, timeout=90):
+        """yields (page response, entries) of drive/entries pages in order
 
+        Page 1 tells last_page; the remaining pages are fetched page_window
+        at a time. With limit, pages past that many entries are not fetched
+        and the last page's entries are cut.
+        """
+        if limit is not None and limit <= 0:
+            return
+        first = self._get_entries_page(params_for_page(1), timeout=timeout)
+        yield first, first["data"][:limit]
+
+        per_page = max(len(first["data"]), 1)
+        pages = range(2, int(first.get("last_page", 1)) + 1)
+        if limit is not None:
+            pages = pages[:max(0, -(-(limit - len(first["data"]))
+                                    // per_page))]
+            limit -= len(first["data"])
+        if len(pages) == 0:
+            return
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.page_window, len(pages)))
+        try:
+            for resp in executor.map(
+                    lambda page: self._get_entries_page(
+                        params_for_page(page), timeout=timeout), pages):
+                yield resp, resp["data"][:limit]
+                if limit is not None:
+                    limit -= len(resp["data"])
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def iter_recent(self, all=False, count=0):
+        """recent entries, newest first, yielded as their pages arrive"""
+        for _, entries in self._iter_entry_pages(
+                self._recent_params, limit=None if all else count):
+            for entry in entries:
+                yield entry
+
+    def get_recent(self, all=False, count=0):
+        self.last_resp = {"data": []}
+        data = []
+        for resp, entries in self._iter_entry_pages(
+                self._recent_params, limit=None if all else count):
+            if not data:
+                self.last_resp = resp
+            data.extend(entries)
+        self.last_resp["data"] = data
         return self.last_resp
 
-    @retry(tries=3, delay=3)
+    @retried("search")
     def get_search_rez(self, query):
         self.logger.info("searching ({}) .....".format(query))
-        params = [('orderBy', 'name'), ('orderDir', ''),
-                  ('type', ''), ('query', query)]
-        resp = self.get(self.URL + "drive/entries", params=params, timeout=deftimeout)
+        params = self._search_params(query)
+        resp = self._cached(
+            "search:" + query,
+            lambda: self.get(self.URL + "drive/entries", params=params,
+                             timeout=deftimeout))
         self.last_resp = resp
         return resp
 
-    def download_all_search_results(self, filesInfo):
-        urls_to_download = filesInfo["data"]
-        sk = 0
-        for url in urls_to_download:
-            sk += 1
-            self.logger.info(str(sk) + "/" + str(len(urls_to_download)))
+    def iter_search(self, query):
+        """entries matching query, every result page, as pages arrive
+
+        With a cache (or offline) the whole result set is cached as one
+        "search:all:" listing and comes from there.
+        """
+        params_for_page = functools.partial(self._search_params, query)
+        if self.cache is None and not self.offline:
+            for _, entries in self._iter_entry_pages(params_for_page,
+                                                     timeout=deftimeout):
+                yield from entries
+            return
+        yield from self._cached(
+            "search:all:" + query,
+            lambda: {"data": [entry for _, entries in self._iter_entry_pages(
+                params_for_page, timeout=deftimeout) for entry in entries]}
+        )["data"]
+
+    def search_many(self, queries):
+        """entries matching any of queries, each one once (by hash)
+
+        The queries run concurrently, page_window at a time, each through
+        all its pages; entries are yielded as soon as their page arrives.
+        """
+        queries = list(dict.fromkeys(queries))
+        if not queries:
+            return
+        self.logger.info("searching ({}) .....".format(", ".join(queries)))
+        pages = queue.Queue()
+        finished = object()
+
+        def fetch(query):
+            try:
+                batch = []
+                for entry in self.iter_search(query):
+                    batch.append(entry)
+                    if len(batch) >= 100:
+                        pages.put(batch)
+                        batch = []
+                pages.put(batch)
+            except BaseException as ex:
+                pages.put(ex)
+            finally:
+                pages.put(finished)
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.page_window, len(queries)))
+        seen = set()
+        running = len(queries)
+        try:
+            for query in queries:
+                executor.submit(fetch, query)
+            while running:
+                item = pages.get()
+                if item is finished:
+                    running -= 1
+                elif isinstance(item, BaseException):
+                    raise item
+                else:
+                    for entry in item:
+                        key = entry.get("hash") or entry.get("id")
+                        if key not in seen:
+                            seen.add(key)
+                            yield entry
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_search_many(self, queries):
+        """search_many() as one response ({"data": [...]}) in last_resp"""
+        self.last_resp = {"data": list(self.search_many(queries))}
+        return self.last_resp
+
+    def download_all_search_results(self, filesInfo, jobs=None):
+        files = []
+        hashes = set()
+        names = set()
+        for url in filesInfo["data"]:
             if url["type"] == "folder":
                 self.logger.info("skipping folder: " + url["name"])
+            elif url["hash"] not in hashes:
+                hashes.add(url["hash"])
+                # same name, other file (e.g. from another folder): the
+                # jobs run at the same time, so each gets its own name
+                file_name = Tools.free_name(url["name"], names)
+                if file_name != url["name"]:
+                    self.logger.info("'{}' ({}) is saved as '{}'".format(
+                        url["name"], url["hash"], file_name))
+                else:
+                    file_name = None
+                files.append({"file_info": url, "file_name": file_name})
+        return self._run_jobs("download", files, jobs)
+
+    def _run_job(self, kind, args):
+        if kind == "upload":
+            self.upload_one_with_retry(args["path"], args["folder_id"],
+                                       args["folder_hash"])
+        else:
+            self.download_file_with_retry(args["file_info"],
+                                          args["file_name"])
+
+    @staticmethod
+    def _job_key(kind, args):
+        """(key, args) for job_queue, paths made absolute for later runs"""
+        if kind == "upload":
+            args = dict(args, path=os.path.abspath(args["path"]))
+            return args["path"] + "|" + args["folder_hash"], args
+        args = dict(args, file_name=os.path.abspath(
+            args["file_name"] or args["file_info"]["name"]))
+        return args["file_info"]["hash"] + "|" + args["file_name"], args
+
+    @staticmethod
+    def _job_label(kind, args):
+        if kind == "upload":
+            return args["path"]
+        return args["file_name"] or args["file_info"]["name"]
+
+    @staticmethod
+    def _job_size(kind, args):
+        if kind == "download":
+            return int(args["file_info"]["file_size"])
+        try:
+            return os.path.getsize(args["path"])
+        except OSError:
+            return 0
+
+    def _run_jobs(self, kind, job_args, jobs=None, job_ids=None,
+                  raise_on_failure=True):
+        """runs upload / download jobs (dicts of _run_job arguments)
+
+        With a job_queue every job is recorded before the first one starts
+        and marked done when it finished (see JobQueue).
+        """
+        if job_ids is None and self.job_queue is not None:
+            keyed = [self._job_key(kind, args) for args in job_args]
+            job_args = [args for _, args in keyed]
+            job_ids = self.job_queue.add_all(kind, keyed)
+        items = list(zip(job_ids or [None] * len(job_args), job_args))
+
+        def run(item):
+            job_id, args = item
+            if job_id is None:
+                self._run_job(kind, args)
+            elif not self.job_queue.run(
+                    job_id, lambda: self._run_job(kind, args)):
+                self.logger.info("job {} ({}) is done or running elsewhere".
+                                 format(job_id, self._job_label(kind, args)))
+
+        scheduler = TransferScheduler(self, jobs=jobs or self.jobs, name=kind)
+        scheduler.run(items, run,
+                      label=lambda item: self._job_label(kind, item[1]),
+                      size=lambda item: self._job_size(kind, item[1]))
+        if raise_on_failure:
+            scheduler.raise_on_failure()
+        return scheduler
+
+    def resume_jobs(self, jobs=None):
+        """runs the unfinished jobs of job_queue again (--resumejobs)"""
+        schedulers = []
+        for kind in ("upload", "download"):
+            unfinished = self.job_queue.unfinished(kind)
+            if not unfinished:
+                continue
+            self.logger.info("resuming {} {} job(s)".format(len(unfinished),
+                                                             kind))
+            schedulers.append(self._run_jobs(
+                kind, [args for _, args in unfinished], jobs,
+                job_ids=[job_id for job_id, _ in unfinished],
+                raise_on_failure=False))
+        if not schedulers:
+            self.logger.info("no unfinished jobs")
+        for scheduler in schedulers:
+            scheduler.raise_on_failure()
+        return schedulers
+
+
+class FolderIndex(object):
+    """lookup tables over the folder list (drive/users/{id}/folders)
+
+    Kept up to date with add() when folders are created, so lookups never
+    need to rescan or refetch the whole list. Names compare without case;
+    of folders with the same name (in one parent) the first one added is
+    found, by name and by path alike.
+    """
+
+    def __init__(self, folders=()):
+        self.by_id = {}
+        self.by_hash = {}
+        self.by_name = {}
+        self.by_parent = {}
+        for folder in folders:
+            self.add(folder)
+
+    @staticmethod
+    def split(path):
+        return [x for x in path.split("/") if x != ""]
+
+    @staticmethod
+    def _parent_key(parent_id):
+        # root folders come with parent_id null (or 0)
+        return parent_id or None
+
+    def add(self, folder):
+        self.by_id[folder["id"]] = folder
+        self.by_hash[folder["hash"]] = folder
+        self.by_name.setdefault(folder["name"].upper(), []).append(folder)
+        self.by_parent.setdefault(self._parent_key(folder.get("parent_id")),
+                                  {}).setdefault(folder["name"].upper(),
+                                                 folder)
+
+    def child(self, parent, name):
+        """folder name directly inside parent (None - root)"""
+        parent_id = parent["id"] if parent is not None else None
+        return self.by_parent.get(parent_id, {}).get(name.upper())
+
+    def lookup(self, path, parent=None):
+        """folder by name or "a/b/c" path, None if not found
+
+        A single name without parent matches anywhere (first found), as
+        folder names have always been looked up that way.
+        """
+        names = self.split(path)
+        if not names:
+            return parent
+        if parent is None and len(names) == 1 and "/" not in path:
+            found = self.by_name.get(names[0].upper())
+            return found[0] if found else None
+        folder = parent
+        for name in names:
+            folder = self.child(folder, name)
+            if folder is None:
+                return None
+        return folder
+
+    def path(self, folder):
+        """"a/b/c" path of folder from the root"""
+        names = []
+        while folder is not None:
+            names.append(folder["name"])
+            folder = self.by_id.get(self._parent_key(folder.get("parent_id")))
+        return "/".join(reversed(names))
+
+    def children(self, parent):
+        parent_id = parent["id"] if parent is not None else None
+        return list(self.by_parent.get(parent_id, {}).values())
+
+
+class MetadataCache(object):
+    """on-disk (sqlite) cache of drive listings
+
+    api responses (root/folder listings, folder tree, searches) by key,
+    each valid for ttl seconds. Clients put their account and api url in
+    front of the keys (ThunderDriveAPI._cache_key): several accounts can
+    share one cache file.
+    """
+
+    default_path = os.path.join(os.path.expanduser("~"), ".thunderdrive",
+                                "cache.db")
+
+    def __init__(self, path=None, ttl=600):
+        self.path = path or self.default_path
+        self.ttl = ttl
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS listings (
+                key TEXT PRIMARY KEY, fetched_at REAL, payload TEXT);
+            -- per-entry table of older versions, never read
+            DROP TABLE IF EXISTS entries;
+        """)
+        with self.db:
+            # keys of older versions, not scoped to an account
+            self.db.execute("DELETE FROM listings WHERE key = 'folders' OR "
+                            "substr(key, 1, 7) IN ('folder:', 'search:')")
+
+    def get(self, key, ignore_ttl=False):
+        """cached payload of key; None if missing or older than ttl"""
+        with self._lock:
+            row = self.db.execute(
+                "SELECT fetched_at, payload FROM listings WHERE key = ?",
+                (key,)).fetchone()
+        if row is None:
+            return None
+        if not ignore_ttl and time.time() - row[0] > self.ttl:
+            return None
+        return json.loads(row[1])
+
+    def put(self, key, payload):
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?)",
+                            (key, time.time(), json.dumps(payload)))
+
+    def invalidate(self, *keys, prefix=None):
+        with self._lock, self.db:
+            self.db.executemany("DELETE FROM listings WHERE key = ?",
+                                [(key,) for key in keys])
+            if prefix is not None:
+                self.db.execute("DELETE FROM listings WHERE "
+                                "substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+    def clear(self):
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM listings")
+
+    def close(self):
+        self.db.close()
+
+
+class Manifest(object):
+    """local record of file content hashes and finished uploads (--manifest)
+
+    files   - sha256 of local files, reused while path, size and mtime are
+              unchanged, so a file is only read again after it changes
+    uploads - content hash and target folder of every finished upload
+    """
+
+    default_path = os.path.join(os.path.expanduser("~"), ".thunderdrive",
+                                "manifest.db")
+    read_size = 1024 * 1024 * 8
+
+    def __init__(self, path=None):
+        self.path = path or self.default_path
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,
+                sha256 TEXT);
+            CREATE TABLE IF NOT EXISTS uploads (
+                sha256 TEXT, folder_hash TEXT, name TEXT, size INTEGER,
+                uploaded_at REAL, PRIMARY KEY (sha256, folder_hash));
+        """)
+
+    def file_hash(self, path):
+        """sha256 of path, from the manifest while the file is unchanged"""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self._lock:
+            row = self.db.execute(
+                "SELECT sha256 FROM files WHERE path = ? AND size = ? "
+                "AND mtime_ns = ?", (path, st.st_size, st.st_mtime_ns)).\
+                fetchone()
+        if row is not None:
+            return row[0]
+
+        digest = hashlib.sha256()
+        buf = bytearray(self.read_size)
+        view = memoryview(buf)
+        with open(path, "rb", buffering=0) as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                digest.update(view[:n])
+        sha256 = digest.hexdigest()
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                            (path, st.st_size, st.st_mtime_ns, sha256))
+        return sha256
+
+    def is_uploaded(self, path, folder_hash):
+        sha256 = self.file_hash(path)
+        with self._lock:
+            return self.db.execute(
+                "SELECT 1 FROM uploads WHERE sha256 = ? AND folder_hash = ?",
+                (sha256, folder_hash)).fetchone() is not None
+
+    def record_upload(self, path, folder_hash):
+        sha256 = self.file_hash(path)
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)",
+                (sha256, folder_hash, os.path.basename(path),
+                 os.path.getsize(path), time.time()))
+
+    def close(self):
+        self.db.close()
+
+
+class ChangeFeed(object):
+    """entries added to the drive since the last poll (--feed, --follow)
+
+    The recent listing is ordered by created_at, newest first. The feed
+    keeps a high water mark, the newest created_at it returned and the
+    hashes it saw with exactly that created_at, and reads pages only until
+    it meets entries below the mark: a poll with nothing new costs one
+    request. The mark is saved to path (JSON) when given. Without a mark,
+    backfill=False starts the feed at the newest entry instead of
+    returning the whole drive.
+    """
+
+    default_path = os.path.join(os.path.expanduser("~"), ".thunderdrive",
+                                "feed.json")
+
+    def __init__(self, thunder_cl, path=None, state=None, backfill=False):
+        self.thunder_cl = thunder_cl
+        self.path = path
+        self.backfill = backfill
+        self.state = state
+        if self.state is None:
+            self.state = self._load()
+        self._pending = None
+
+    def _load(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_name = self.path + ".tmp"
+        with open(tmp_name, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_name, self.path)
+
+    def poll(self, commit=True):
+        """new entries, oldest first
+
+        With commit=False the mark only moves on commit(), so entries are
+        returned again if the caller dies before handling them.
+        """
+        mark = self.state.get("created_at")
+        seen = set(self.state.get("hashes", []))
+        new = []
+        for _, entries in self.thunder_cl._iter_entry_pages(
+                self.thunder_cl._recent_params):
+            reached = False
+            for entry in entries:
+                created = entry.get("created_at") or ""
+                if mark is not None and created <= mark:
+                    reached = reached or created < mark
+                    if created < mark or entry["hash"] in seen:
+                        continue
+                new.append(entry)
+            if reached or (mark is None and not self.backfill):
+                break
+
+        newest = max([x.get("created_at") or "" for x in new] +
+                     ([mark] if mark is not None else []), default=None)
+        hashes = [x["hash"] for x in new
+                  if (x.get("created_at") or "") == newest]
+        if newest == mark:
+            hashes = sorted(seen.union(hashes))
+        self._pending = {"created_at": newest, "hashes": hashes}
+        if mark is None and not self.backfill:
+            new = []
+        if commit:
+            self.commit()
+        new.reverse()
+        return new
+
+    def commit(self):
+        """moves the mark past the entries of the last poll"""
+        if self._pending is not None and\
+                self._pending["created_at"] is not None:
+            self.state = self._pending
+            self._save()
+        self._pending = None
+
+    def follow(self, interval=60):
+        """polls every interval seconds, yielding new entries forever
+
+        An entry's mark is committed when the next one is asked for.
+        """
+        while True:
+            for entry in self.poll(commit=False):
+                yield entry
+            self.commit()
+            time.sleep(interval)
+
+
+class DriveIndex(object):
+    """local index of the whole drive for --find (sqlite)
+
+    entries - every file and folder: name, parent folder, type, size and
+              created_at, plus the api entry as JSON
+    meta    - state of the ChangeFeed that refresh() reads new entries
+              from, so after the first build only new entries are fetched
+
+    Folder paths come from the folder
+    list at query time, so renamed folders show their new path; deleted,
+    renamed or moved files are only dropped by refresh(full=True).
+    """
+
+    default_path = os.path.join(os.path.expanduser("~"), ".thunderdrive",
+                                "index.db")
+
+    def __init__(self, path=None):
+        self.path = path or self.default_path
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.create_function("REGEXP", 2, self._regexp,
+                                deterministic=True)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                hash TEXT PRIMARY KEY, id INTEGER, parent_id INTEGER,
+                name TEXT, type TEXT, file_size INTEGER, created REAL,
+                payload TEXT);
+            CREATE INDEX IF NOT EXISTS entries_created ON entries (created);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        """)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def _compile(pattern):
+        return re.compile(pattern, re.IGNORECASE)
+
+    @classmethod
+    def _regexp(cls, pattern, value):
+        return value is not None and\
+            cls._compile(pattern).search(value) is not None
+
+    def _meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?",
+                              (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    @staticmethod
+    def _row(entry):
+        created = None
+        if entry.get("created_at"):
+            created = Tools.parse_time(entry["created_at"])
+        return (entry["hash"], entry.get("id"), entry.get("parent_id"),
+                entry.get("name"), entry.get("type"), entry.get("file_size"),
+                created, json.dumps(entry))
+
+    def refresh(self, thunder_cl, full=False):
+        """adds entries created since the last refresh (all with full);
+        returns how many were new"""
+        with self._lock:
+            state = None if full else self._meta("feed")
+        feed = ChangeFeed(thunder_cl, state=json.loads(state or "{}"),
+                          backfill=True)
+        new = feed.poll()
+        rows = [self._row(x) for x in thunder_cl.get_all_folders() + new
+                if x.get("hash")]
+        with self._lock, self.db:
+            if full:
+                self.db.execute("DELETE FROM entries")
+            self.db.executemany("INSERT OR REPLACE INTO entries VALUES "
+                                "(?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES "
+                            "('feed', ?)", (json.dumps(feed.state),))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES "
+                            "('refreshed_at', ?)", (time.time(),))
+        thunder_cl.logger.info("index: {} new entries, {} indexed".format(
+            len(new), self.count()))
+        return len(new)
+
+    def count(self):
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM entries").\
+                fetchone()[0]
+
+    def folders(self):
+        """FolderIndex of the indexed folders"""
+        with self._lock:
+            rows = self.db.execute("SELECT payload FROM entries WHERE "
+                                   "type = 'folder'").fetchall()
+        return FolderIndex(json.loads(row[0]) for row in rows)
+
+    def find(self, glob=None, regex=None, type=None, min_size=None,
+             max_size=None, after=None, before=None, limit=None):
+        """api entries matching all given predicates, newest first
+
+        glob and regex match the name (case insensitive), or the whole
+        "folder/sub/name" path when they contain a "/"; each entry gets
+        that path as "path_name". after / before are unix times.
+        """
+        where, args = [], []
+        path_patterns = []
+        for pattern in (["^" + fnmatch.translate(glob)] if glob else []) +\
+                ([regex] if regex else []):
+            if "/" in pattern:
+                path_patterns.append(self._compile(pattern))
             else:
-                self.download_file_with_retry(url)
-                # try:
-                #     self.download_file_with_retry(url)
-                # except Exception as ex:
-                #     self.logger.exception(ex)
-
-    speedList = []
-
-    def calculateSpeddAVG(self, el):
-        llen = 10
-        killSpeed = 1024*70  # 70KB
-        if type(el) == int:
-            self.speedList.append(el)
-            if len(self.speedList) > llen:
-                self.speedList.pop(0)
-
-            avg = sum(self.speedList) / len(self.speedList)
-
-            if len(self.speedList) >= llen and avg < killSpeed:
-                print("")
-                print(self.speedList)
-                print(Tools.sizeof_fmt(int(avg)), len(self.speedList),
-                      Tools.sizeof_fmt(killSpeed))
-                self.speedList.clear()
-                raise Exception("Auto restart slow download !!!")
-
-            # return Tools.sizeof_fmt(int(avg))
-        return ""
+                where.append("name REGEXP ?")
+                args.append(pattern)
+        for clause, value in (("type = ?", type),
+                              ("file_size >= ?", min_size),
+                              ("file_size <= ?", max_size),
+                              ("created >= ?", after),
+                              ("created < ?", before)):
+            if value is not None:
+                where.append(clause)
+                args.append(value)
+        sql = "SELECT payload FROM entries"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created DESC"
+        with self._lock:
+            rows = self.db.execute(sql, args).fetchall()
+
+        folders = self.folders()
+        found = []
+        for row in rows:
+            entry = json.loads(row[0])
+            parent = folders.by_id.get(entry.get("parent_id"))
+            entry["path_name"] = "/".join(
+                x for x in (folders.path(parent), entry["name"]) if x)
+            if all(p.search(entry["path_name"]) for p in path_patterns):
+                found.append(entry)
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+    def close(self):
+        self.db.close()
+
+
+class JobQueue(object):
+    """persistent queue of transfers (--jobqueue, --resumejobs)
+
+    jobs - one row per upload / download: its arguments as JSON and its
+           state, pending -> running -> done or failed
+
+    A run records all its transfers as pending before the first starts.
+    Each job is claimed (running, with the pid of the process) right
+    before it runs and marked done right after, in one update that only
+    succeeds while the claim holds, so no job is completed twice. Jobs
+    left pending, failed, or running in a process that is gone (crash,
+    reboot, ctrl+C) are what --resumejobs runs again.
+    """
+
+    default_path = os.path.join(os.path.expanduser("~"), ".thunderdrive",
+                                "jobs.db")
+    keep_done = 7 * 24 * 3600
+
+    def __init__(self, path=None):
+        self.path = path or self.default_path
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False,
+                                  timeout=30)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY, kind TEXT, key TEXT, args TEXT,
+                state TEXT, pid INTEGER, attempts INTEGER, error TEXT,
+                created_at REAL, updated_at REAL);
+            CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, kind);
+        """)
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM jobs WHERE state = 'done' AND "
+                            "updated_at < ?", (time.time() - self.keep_done,))
+
+    def add_all(self, kind, jobs):
+        """[(key, args)] -> [job id]; an unfinished job with the same key
+        is reused instead of added twice"""
+        ids = []
+        now = time.time()
+        with self._lock, self.db:
+            for key, args in jobs:
+                row = self.db.execute(
+                    "SELECT id FROM jobs WHERE kind = ? AND key = ? AND "
+                    "state != 'done'", (kind, key)).fetchone()
+                if row is not None:
+                    ids.append(row[0])
+                    continue
+                cur = self.db.execute(
+                    "INSERT INTO jobs (kind, key, args, state, attempts, "
+                    "created_at, updated_at) VALUES "
+                    "(?, ?, ?, 'pending', 0, ?, ?)",
+                    (kind, key, json.dumps(args), now, now))
+                ids.append(cur.lastrowid)
+        return ids
+
+    @staticmethod
+    def _alive(pid):
+        if pid is None:
+            return False
+        if pid == os.getpid():
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def unfinished(self, kind):
+        """[(job id, args)] of jobs to run again, oldest first"""
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT id, state, pid, args FROM jobs WHERE kind = ? AND "
+                "state != 'done' ORDER BY id", (kind,)).fetchall()
+        return [(job_id, json.loads(args)) for job_id, state, pid, args in rows
+                if state != "running" or not self._alive(pid)]
+
+    def _claim(self, job_id):
+        """marks the job running in this process; False if it is done or
+        another live process runs it"""
+        with self._lock, self.db:
+            row = self.db.execute("SELECT state, pid FROM jobs WHERE id = ?",
+                                  (job_id,)).fetchone()
+            if row is None or row[0] == "done" or\
+                    (row[0] == "running" and row[1] != os.getpid() and
+                     self._alive(row[1])):
+                return False
+            # compare and set: loses if another process claimed it meanwhile
+            cur = self.db.execute(
+                "UPDATE jobs SET state = 'running', pid = ?, "
+                "attempts = attempts + 1, updated_at = ? WHERE id = ? AND "
+                "state = ? AND pid IS ?",
+                (os.getpid(), time.time(), job_id, row[0], row[1]))
+            return cur.rowcount == 1
+
+    def _end(self, job_id, state, error=None):
+        with self._lock, self.db:
+            cur = self.db.execute(
+                "UPDATE jobs SET state = ?, error = ?, updated_at = ? "
+                "WHERE id = ? AND state = 'running' AND pid = ?",
+                (state, error, time.time(), job_id, os.getpid()))
+            return cur.rowcount == 1
+
+    def run(self, job_id, func):
+        """func() as job job_id; False (func not called) if not claimed
+
+        Exceptions mark the job failed; ctrl+C and aborts leave it running,
+        which --resumejobs treats as unfinished once this process is gone.
+        """
+        if not self._claim(job_id):
+            return False
+        try:
+            func()
+        except Exception as ex:
+            self._end(job_id, "failed", str(ex))
+            raise
+        self._end(job_id, "done")
+        return True
+
+    def counts(self):
+        with self._lock:
+            return dict(self.db.execute(
+                "SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def close(self):
+        self.db.close()
+
+
+class PartialDownload(object):
+    """download in progress: <name>.part data and <name>.part.json journal
+
+    The journal records how many bytes of the .part file are known to be
+    on disk (one offset, or one per segment for segmented downloads), so an
+    interrupted download can continue with Range requests. It is committed
+    (data fsynced, then the journal written) every commit_interval seconds
+    and when a try ends early; a download that completes needs no commit.
+    """
+
+    commit_interval = 5.0
+
+    def __init__(self, file_name, file_info):
+        self.file_name = file_name
+        self.part_name = file_name + ".part"
+        self.journal_name = self.part_name + ".json"
+        self.file_hash = file_info["hash"]
+        self.file_size = int(file_info["file_size"])
+        self.offset = 0
+        self.segments = []
+        self.committed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _read_journal(self):
+        """journal of this very file (hash and size match) or None"""
+        try:
+            with open(self.journal_name) as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if journal.get("hash") != self.file_hash or\
+                journal.get("file_size") != self.file_size or\
+                not os.path.exists(self.part_name):
+            return None
+        return journal
+
+    def _write_journal(self, **state):
+        tmp_name = self.journal_name + ".tmp"
+        with open(tmp_name, "w") as jf:
+            json.dump(dict(hash=self.file_hash, file_size=self.file_size,
+                           **state), jf)
+        os.replace(tmp_name, self.journal_name)
+
+    def load(self):
+        """offset to resume from; 0 when there is no matching journal"""
+        journal = self._read_journal()
+        if journal is None or "offset" not in journal:
+            return 0
+        self.offset = min(int(journal["offset"]),
+                          os.path.getsize(self.part_name))
+        return self.offset
+
+    def load_segments(self, count):
+        """[start, end, pos] byte ranges, resumed from the journal if possible
+
+        A fresh .part file is preallocated to the full size so segments can
+        be written in place with positional writes.
+        """
+        journal = self._read_journal()
+        if journal is not None and "segments" in journal and\
+                os.path.getsize(self.part_name) == self.file_size:
+            self.segments = [list(seg) for seg in journal["segments"]]
+            return self.segments
+
+        step = -(-self.file_size // count)
+        self.segments = [[beg, min(beg + step, self.file_size), beg]
+                         for beg in range(0, self.file_size, step)]
+        with open(self.part_name, "wb") as f:
+            self.preallocate(f, self.file_size)
+        self._write_journal(segments=self.segments)
+        return self.segments
+
+    @staticmethod
+    def preallocate(f, size):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            pass
+        f.truncate(size)
+
+    def open(self, offset, preallocate_size=None):
+        """.part file positioned at offset, anything after it dropped
+
+        With preallocate_size the file is then allocated to that size in
+        one go (the bytes past offset are not valid until committed).
+        """
+        f = open(self.part_name, 'r+b' if offset > 0 else 'wb')
+        f.seek(offset)
+        f.truncate()
+        if preallocate_size is not None and preallocate_size > offset:
+            self.preallocate(f, preallocate_size)
+        self.offset = offset
+        return f
+
+    def due(self, committed_at=None):
+        """True once commit_interval passed since committed_at (or the last
+        commit)"""
+        if committed_at is None:
+            committed_at = self.committed_at
+        return time.monotonic() - committed_at >= self.commit_interval
+
+    def commit(self, f, offset):
+        f.flush()
+        os.fsync(f.fileno())
+        self.offset = offset
+        self._write_journal(offset=offset)
+        self.committed_at = time.monotonic()
+
+    def commit_segment(self, fd, index, pos):
+        os.fsync(fd)
+        with self._lock:
+            self.segments[index][2] = pos
+            self._write_journal(segments=self.segments)
+
+    def complete(self):
+        return all(seg[2] >= seg[1] for seg in self.segments) and\
+            os.path.getsize(self.part_name) == self.file_size
+
+    def finish(self):
+        os.replace(self.part_name, self.file_name)
+        try:
+            os.remove(self.journal_name)
+        except FileNotFoundError:
+            pass
+
+    def discard(self):
+        for name in (self.part_name, self.journal_name):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+
+class TransferStalled(Exception):
+    """raised by StallDetector; the transfer is retried (and resumed)"""
+
+
+class StallDetector(object):
+    """decides when a running transfer has stalled and should restart
+
+    Bytes are summed into wall-clock windows of `window` seconds, whose
+    rates go into a ring buffer (the last `windows` of them) and into an
+    EWMA. The transfer counts as slow while the EWMA is under `ratio` of
+    its own peak in the ring buffer (or under `min_rate`, if set); slow
+    for `grace` seconds in a row means stalled. Nothing is judged during
+    the first `warmup` seconds.
+    """
+
+    window = 1.0
+    windows = 30
+    alpha = 0.3
+    ratio = 0.1
+    grace = 20.0
+    min_rate = 0
+    warmup = 10.0
+
+    def __init__(self, name, logger, rate_cap=None, **settings):
+        for key, value in settings.items():
+            if not hasattr(self, key):
+                raise TypeError("unknown stall setting '{}'".format(key))
+            setattr(self, key, value)
+        self.name = name
+        self.logger = logger
+        self.rate_cap = rate_cap
+        self.rates = collections.deque(maxlen=self.windows)
+        self.ewma = None
+        self.start = self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self.slow_since = None
+
+    def update(self, nbytes):
+        """counts nbytes; raises TransferStalled when the transfer stalled"""
+        self._window_bytes += nbytes
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+        rate = self._window_bytes / elapsed
+        self._window_start = now
+        self._window_bytes = 0
+        self.rates.append(rate)
+        if self.ewma is None:
+            self.ewma = rate
+        else:
+            self.ewma = self.alpha * rate + (1 - self.alpha) * self.ewma
+        if now - self.start >= self.warmup:
+            self._judge(now)
+
+    def _judge(self, now):
+        peak = max(self.rates)
+        if self.rate_cap is not None and self.rate_cap() > 0:
+            peak = min(peak, self.rate_cap())
+        threshold = max(peak * self.ratio, self.min_rate)
+        if self.ewma >= threshold:
+            if self.slow_since is not None:
+                self.logger.info("stall: '{}' recovered ({}/s)".format(
+                    self.name, Tools.sizeof_fmt(int(self.ewma))))
+                self.slow_since = None
+            return
+        if self.slow_since is None:
+            self.slow_since = now
+            self.logger.info("stall: '{}' slow, {}/s < {}/s (peak {}/s)".
+                             format(self.name,
+                                    Tools.sizeof_fmt(int(self.ewma)),
+                                    Tools.sizeof_fmt(int(threshold)),
+                                    Tools.sizeof_fmt(int(peak))))
+        elif now - self.slow_since >= self.grace:
+            self.logger.info("stall: '{}' slow for {:.0f}s, restarting".
+                             format(self.name, now - self.slow_since))
+            raise TransferStalled("Auto restart stalled transfer '{}' "
+                                  "({}/s, peak {}/s)".
+                                  format(self.name,
+                                         Tools.sizeof_fmt(int(self.ewma)),
+                                         Tools.sizeof_fmt(int(peak))))
+
+
+class RateLimiter(object):
+    """token bucket shared by every transfer of a client (--maxrate)
+
+    rate is in bytes/s, 0 means unlimited. schedule entries
+    (start minute, end minute, rate) override it at those times of day.
+    Transfers call consume() after moving bytes; callers that go over the
+    budget sleep off their share of the debt.
+    """
+
+    def __init__(self, rate=0, schedule=None):
+        self.rate = rate
+        self.schedule = schedule or []
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = time.monotonic()
+
+    @staticmethod
+    def parse_schedule(text):
+        """"08:00-18:00=2M,18:00-08:00=0" -> [(480, 1080, 2097152), ...]"""
+        schedule = []
+        for item in text.split(","):
+            period, rate = item.split("=")
+            start, end = period.split("-")
+            schedule.append((RateLimiter._minute(start),
+                             RateLimiter._minute(end), Tools.parse_size(rate)))
+        return schedule
+
+    @staticmethod
+    def _minute(hh_mm):
+        hours, minutes = hh_mm.strip().split(":")
+        return int(hours) * 60 + int(minutes)
+
+    def current_rate(self):
+        now = datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            if start <= minute < end or\
+                    (end < start and (minute >= start or minute < end)):
+                return rate
+        return self.rate
+
+    def consume(self, nbytes):
+        rate = self.current_rate()
+        if rate <= 0 or nbytes <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # at most one second of unused budget is saved up
+            self._tokens = min(float(rate),
+                               self._tokens + (now - self._last) * rate)
+            self._last = now
+            self._tokens -= nbytes
+            wait = -self._tokens / rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Metrics(object):
+    """machine readable request / transfer metrics (--metrics, --prometheus)
+
+    Every event is a dict with "event" and "ts" (unix time); it is written
+    as one JSON line to `path` and passed to each function in callbacks.
+    Totals are kept for write_prometheus(), which dumps them in the
+    Prometheus text format (e.g. for node_exporter's textfile collector).
+    """
+
+    prefix = "thunderdrive_"
+
+    def __init__(self, path=None, prometheus_file=None):
+        self.path = path
+        self.prometheus_file = prometheus_file
+        self.callbacks = []
+        self._lock = threading.Lock()
+        self._file = None
+        if path is not None:
+            self._file = open(path, "a", buffering=1)
+        self.requests = collections.Counter()  # (method, status)
+        self.request_seconds = collections.Counter()  # method
+        self.retries = collections.Counter()  # operation
+        self.transfers = collections.Counter()  # (direction, result)
+        self.transfer_bytes = collections.Counter()  # direction
+        self.transfer_seconds = collections.Counter()  # direction
+        self.transfer_cpu_seconds = collections.Counter()  # direction
+
+    def emit(self, event, **fields):
+        record = dict(fields, event=event, ts=round(time.time(), 3))
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(record) + "\n")
+        for callback in self.callbacks:
+            callback(record)
+
+    def request(self, method, url, status, seconds, nbytes=None):
+        """one http request; status is None when no response came"""
+        with self._lock:
+            self.requests[(method, status or "error")] += 1
+            self.request_seconds[method] += seconds
+        self.emit("request", method=method, url=url, status=status,
+                  seconds=round(seconds, 4), bytes=nbytes)
+
+    def retry(self, operation, attempt, error=None, wait=None):
+        with self._lock:
+            self.retries[operation] += 1
+        self.emit("retry", operation=operation, attempt=attempt,
+                  error=str(error) if error is not None else None,
+                  wait=round(wait, 3) if wait is not None else None)
+
+    def transfer(self, direction, name, nbytes, seconds, complete,
+                 cpu_seconds=None):
+        """one upload / download attempt; nbytes is what moved this time
+
+        cpu_seconds is process cpu time while it ran (with parallel jobs
+        it includes the other transfers).
+        """
+        result = "complete" if complete else "incomplete"
+        with self._lock:
+            self.transfers[(direction, result)] += 1
+            self.transfer_bytes[direction] += nbytes
+            self.transfer_seconds[direction] += seconds
+            if cpu_seconds is not None:
+                self.transfer_cpu_seconds[direction] += cpu_seconds
+        cpu_per_gb = None
+        if cpu_seconds is not None and nbytes > 0:
+            cpu_per_gb = round(cpu_seconds / nbytes * 1024 ** 3, 3)
+        self.emit("transfer", direction=direction, name=name, bytes=nbytes,
+                  seconds=round(seconds, 3),
+                  rate=int(nbytes / seconds) if seconds > 0 else None,
+                  cpu_seconds=round(cpu_seconds, 3)
+                  if cpu_seconds is not None else None,
+                  cpu_per_gb=cpu_per_gb, result=result)
+        if self.prometheus_file is not None:
+            self.write_prometheus()
+
+    def _prometheus_lines(self):
+        metrics = [
+            ("requests_total", "counter", "API requests.",
+             self.requests, ("method", "status")),
+            ("request_seconds_total", "counter",
+             "Time spent in API requests.",
+             self.request_seconds, ("method",)),
+            ("retries_total", "counter", "Retried operations.",
+             self.retries, ("operation",)),
+            ("transfers_total", "counter", "Upload / download attempts.",
+             self.transfers, ("direction", "result")),
+            ("transfer_bytes_total", "counter", "Bytes transferred.",
+             self.transfer_bytes, ("direction",)),
+            ("transfer_seconds_total", "counter", "Time spent transferring.",
+             self.transfer_seconds, ("direction",)),
+            ("transfer_cpu_seconds_total", "counter",
+             "Process cpu time during transfers.",
+             self.transfer_cpu_seconds, ("direction",)),
+        ]
+        lines = []
+        for name, kind, doc, values, labels in metrics:
+            lines.append("# HELP {}{} {}".format(self.prefix, name, doc))
+            lines.append("# TYPE {}{} {}".format(self.prefix, name, kind))
+            for key, value in sorted(values.items(), key=str):
+                if not isinstance(key, tuple):
+                    key = (key,)
+                label_str = ",".join('{}="{}"'.format(label, v)
+                                     for label, v in zip(labels, key))
+                lines.append("{}{}{{{}}} {}".format(self.prefix, name,
+                                                   label_str, value))
+        return lines
+
+    def write_prometheus(self, path=None):
+        """writes the totals to path (default prometheus_file), atomically"""
+        path = path or self.prometheus_file
+        with self._lock:
+            text = "\n".join(self._prometheus_lines()) + "\n"
+        tmp_name = path + ".tmp"
+        with open(tmp_name, "w") as f:
+            f.write(text)
+        os.replace(tmp_name, path)
+
+    def close(self):
+        if self.prometheus_file is not None:
+            self.write_prometheus()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class TransferProgress(object):
+    """bytes moved by one transfer; made by ProgressDisplay.start()
+
+    total is None while the size is unknown (streams).
+    """
+
+    def __init__(self, display, name, total, done=0):
+        self.display = display
+        self.name = name
+        self.total = max(int(total), 0) if total is not None else None
+        self.done = self.initial = done
+        self.start = time.monotonic()
+        self.cpu_start = time.process_time()
+
+    def update(self, nbytes):
+        """counts nbytes that really went over the wire"""
+        if nbytes:
+            self.display._add(self, nbytes)
+
+    @property
+    def fraction(self):
+        if self.total is None:
+            return None
+        if self.total == 0:
+            return 1.0
+        return min(self.done / self.total, 1.0)
+
+    @property
+    def complete(self):
+        return self.total is not None and self.done >= self.total
+
+
+class ProgressDisplay(object):
+    """one terminal progress line for all running transfers of a client
+
+    Transfers report the bytes they actually moved; the line is redrawn
+    at most every `interval` seconds, whichever thread reports. Rate is an
+    EWMA (weight `alpha`) of the bytes moved between redraws, on the
+    monotonic clock, and the ETA is what is left at that rate. Inside a
+    batch (begin_batch / end_batch, see TransferScheduler) the line sums
+    up the whole batch instead of the running transfers.
+    """
+
+    interval = 0.5
+    alpha = 0.3
+    fill = '█'
+
+    def __init__(self, enabled=True, bar_len=30):
+        self.enabled = enabled
+        self.bar_len = bar_len
+        self._lock = threading.Lock()
+        self.active = []
+        self.batch = None
+        self._reset_rate()
+
+    def _reset_rate(self):
+        self.moved = 0
+        self.rate = None
+        self._last_time = self._last_draw = time.monotonic()
+        self._last_moved = 0
+        self._dirty = False
+
+    def start(self, name, total, done=0):
+        progress = TransferProgress(self, name, total, done)
+        with self._lock:
+            if not self.active and self.batch is None:
+                self._reset_rate()
+            self.active.append(progress)
+            self._draw(time.monotonic())
+        return progress
+
+    def finish(self, progress):
+        with self._lock:
+            if progress in self.active:
+                self.active.remove(progress)
+            if self.batch is not None:
+                # the file's bytes count in file_done(): a failed attempt
+                # is started again (from its offset) and must not add up
+                return
+            self._draw(time.monotonic(), shown=[progress])
+            self._end_line()
+
+    def begin_batch(self, files, total_bytes):
+        with self._lock:
+            self._reset_rate()
+            self.batch = {"files": files, "files_done": 0,
+                          "bytes": total_bytes, "bytes_done": 0}
+
+    def file_done(self, size=0, failed=False):
+        """counts one finished (or skipped, or failed) file of the batch
+
+        A failed file leaves the batch total instead of adding its size.
+        """
+        with self._lock:
+            if self.batch is not None:
+                self.batch["files_done"] += 1
+                if failed:
+                    self.batch["bytes"] -= size
+                else:
+                    self.batch["bytes_done"] += size
+                self._draw(time.monotonic())
+
+    def end_batch(self):
+        with self._lock:
+            if self.batch is not None:
+                self._draw(time.monotonic())
+                self._end_line()
+            self.batch = None
+
+    def _add(self, progress, nbytes):
+        with self._lock:
+            progress.done += nbytes
+            self.moved += nbytes
+            now = time.monotonic()
+            if now - self._last_draw >= self.interval:
+                self._draw(now)
+
+    def _end_line(self):
+        if self._dirty:
+            print()
+        self._dirty = False
+
+    def _draw(self, now, shown=None):
+        elapsed = now - self._last_time
+        if elapsed > 0 and self.moved > self._last_moved:
+            rate = (self.moved - self._last_moved) / elapsed
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate = self.alpha * rate + (1 - self.alpha) * self.rate
+            self._last_time, self._last_moved = now, self.moved
+        self._last_draw = now
+        if not self.enabled:
+            return
+
+        shown = shown if shown is not None else self.active
+        if self.batch is not None:
+            done = self.batch["bytes_done"] + sum(p.done for p in shown)
+            total = self.batch["bytes"]
+            prefix = "T: {}/{}".format(self.batch["files_done"],
+                                       self.batch["files"])
+        elif shown:
+            done = sum(p.done for p in shown)
+            prefix = "P:"
+            if any(p.total is None for p in shown):
+                print("\r{} {} {}/s".format(
+                    prefix, Tools.sizeof_fmt(done),
+                    Tools.sizeof_fmt(int(self.rate or 0))), end="")
+                self._dirty = True
+                return
+            total = sum(p.total for p in shown)
+        else:
+            return
+        fraction = min(done / total, 1.0) if total else 1.0
+        eta = None
+        if self.rate and done < total:
+            eta = (total - done) / self.rate
+        filled = int(self.bar_len * fraction)
+        bar = self.fill * filled + '-' * (self.bar_len - filled)
+        speed = Tools.sizeof_fmt(int(self.rate or 0)) + "/s"
+        print("\r{} |{}| {:.1f}% {} {:<6}".
+              format(prefix, bar, 100 * fraction, speed,
+                     Tools.format_eta(eta)), end="")
+        self._dirty = True
+
+
+class TransferScheduler(object):
+    """runs transfers in a pool of worker threads sharing one api client
+
+    Every worker uses the client's session (and so its login cookies).
+    Failed items are collected instead of stopping the whole batch.
+    """
+
+    def __init__(self, thunder_cl, jobs=1, name="transfer"):
+        self.thunder_cl = thunder_cl
+        self.logger = thunder_cl.logger
+        self.jobs = max(1, int(jobs))
+        self.name = name
+        self.total = 0
+        self.done = []
+        self.failed = []
+        self.bytes_done = 0
+        self._lock = threading.Lock()
+        self._beg_time = None
+        self._label = str
+
+    def _run_one(self, func, item, label, size):
+        try:
+            func(item)
+        except Exception as ex:
+            self.logger.error("{} failed '{}': {}".format(self.name,
+                                                          label(item), ex))
+            with self._lock:
+                self.failed.append((item, ex))
+            self.thunder_cl.progress.file_done(size(item), failed=True)
+        else:
+            with self._lock:
+                self.done.append(item)
+                self.bytes_done += size(item)
+            self.thunder_cl.progress.file_done(size(item))
+
+    def run(self, items, func, label=str, size=lambda x: 0):
+        """calls func(item) for every item, jobs at a time"""
+        items = list(items)
+        self.total = len(items)
+        self._label = label
+        self._beg_time = time.time()
+        self.thunder_cl.abort.clear()
+
+        if self.jobs == 1:
+            for sk, item in enumerate(items, 1):
+                self.logger.info(str(sk) + "/" + str(self.total))
+                self._run_one(func, item, label, size)
+            self.log_summary()
+            return self
+
+        # concurrent transfers share one summed up progress line
+        progress = self.thunder_cl.progress
+        progress.begin_batch(self.total, sum(size(item) for item in items))
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.jobs)
+        try:
+            futures = [executor.submit(self._run_one, func, item, label, size)
+                       for item in items]
+            for fut in concurrent.futures.as_completed(futures):
+                fut.result()
+        except KeyboardInterrupt:
+            self.thunder_cl.abort.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        finally:
+            progress.end_batch()
+        executor.shutdown(wait=True)
+        self.log_summary()
+        return self
+
+    def log_summary(self):
+        elapsed = max(time.time() - self._beg_time, 0.001)
+        self.logger.info("{}: {} done, {} failed of {} files; {} in {:.0f}s "
+                         "({}/s)".format(self.name, len(self.done),
+                                         len(self.failed), self.total,
+                                         Tools.sizeof_fmt(self.bytes_done),
+                                         elapsed,
+                                         Tools.sizeof_fmt(
+                                             int(self.bytes_done / elapsed))))
+        for item, ex in self.failed:
+            self.logger.info("  failed '{}': {}".format(self._label(item), ex))
+
+    def raise_on_failure(self):
+        if self.failed:
+            raise Exception("{} of {} {}s failed".format(len(self.failed),
+                                                         self.total,
+                                                         self.name))
+
+
+class FolderSync(object):
+    """mirrors a local directory and a drive folder tree (--sync)
+
+    Both trees are listed, files are matched by relative path and only the
+    missing or changed ones (other size, or a newer copy on the sending
+    side: local mtime against the drive copy's updated_at / created_at)
+    are transferred, jobs at a time, keeping the directory structure.
+    The drive has no overwrite: a changed file is uploaded next to the old
+    one, and the newest copy of a path is the one compared.
+    """
+
+    def __init__(self, thunder_cl, local_dir, folder=None, download=False):
+        self.thunder_cl = thunder_cl
+        self.logger = thunder_cl.logger
+        self.local_dir = local_dir
+        self.folder = folder
+        self.download = download
+        self.remote = {}
+        self.local = {}
+        self.remote_folders = {}
+
+    def remote_files(self):
+        """{relative path: newest entry} of every file under the drive folder"""
+        files = {}
+        self.remote_folders = {"": self.folder}
+        todo = [("", self.folder)]
+        while todo:
+            prefix, folder = todo.pop()
+            folder_hash = folder["hash"] if folder is not None else ""
+            for entry in self.thunder_cl.get_folder_entries(folder_hash):
+                path = prefix + entry["name"]
+                if entry["type"] == "folder":
+                    self.remote_folders[path] = entry
+                    todo.append((path + "/", entry))
+                elif path not in files or self._remote_mtime(entry) >\
+                        self._remote_mtime(files[path]):
+                    files[path] = entry
+        return files
+
+    def local_files(self):
+        """{relative path: os.stat_result} of every file under local_dir"""
+        files = {}
+        for root, _, names in os.walk(self.local_dir):
+            for name in names:
+                full = os.path.join(root, name)
+                rel = os.path.relpath(full, self.local_dir)
+                files[rel.replace(os.sep, "/")] = os.stat(full)
+        return files
+
+    def plan(self):
+        """relative paths that need a transfer"""
+        remote = self.remote_files()
+        local = self.local_files()
+        self.remote, self.local = remote, local
+        if not self.download:
+            return sorted(rel for rel, st in local.items()
+                          if rel not in remote or
+                          int(remote[rel]["file_size"]) != st.st_size or
+                          st.st_mtime > self._remote_mtime(remote[rel]) + 1)
+        todo = []
+        for rel, entry in remote.items():
+            st = local.get(rel)
+            if st is None or st.st_size != int(entry["file_size"]) or\
+                    self._remote_mtime(entry) > st.st_mtime + 1:
+                todo.append(rel)
+        return sorted(todo)
+
+    @staticmethod
+    def _remote_mtime(entry):
+        return Tools.parse_time(entry.get("updated_at") or
+                                entry["created_at"])
+
+    def run(self, jobs=None):
+        todo = self.plan()
+        self.logger.info("sync: {} of {} files to {}".format(
+            len(todo), len(self.remote if self.download else self.local),
+            "download" if self.download else "upload"))
+        if not self.download:
+            scheduler = self.upload(todo, jobs)
+        else:
+            scheduler = TransferScheduler(self.thunder_cl,
+                                          jobs=jobs or self.thunder_cl.jobs,
+                                          name="download")
+            scheduler.run(todo, self._download_one,
+                          size=lambda rel: int(self.remote[rel]["file_size"]))
+        scheduler.raise_on_failure()
+        return scheduler
+
+    def upload(self, todo, jobs=None):
+        """uploads the files at the relative paths todo, jobs at a time"""
+        scheduler = TransferScheduler(self.thunder_cl,
+                                      jobs=jobs or self.thunder_cl.jobs,
+                                      name="upload")
+        # folders first, one at a time, so workers never race to
+        # create the same one
+        targets = {}
+        for rel_dir in sorted({posixpath.dirname(rel) for rel in todo}):
+            targets[rel_dir] = self._remote_folder(rel_dir)
+        scheduler.run(todo,
+                      lambda rel: self._upload_one(
+                          rel, targets[posixpath.dirname(rel)]),
+                      size=lambda rel: self.local[rel].st_size)
+        return scheduler
+
+    def _remote_folder(self, rel_dir):
+        if rel_dir in self.remote_folders:
+            # None is the drive root
+            return self.remote_folders[rel_dir]
+        folder = self.thunder_cl._make_path(rel_dir, self.folder)
+        if folder is None:
+            raise Exception("sync: can't create folder '{}'".format(rel_dir))
+        self.remote_folders[rel_dir] = folder
+        return folder
+
+    def _upload_one(self, rel, folder):
+        folder_id = str(folder["id"]) if folder is not None else ""
+        folder_hash = folder["hash"] if folder is not None else ""
+        self.thunder_cl.upload_one_with_retry(
+            os.path.join(self.local_dir, rel), folder_id, folder_hash)
+
+    def _download_one(self, rel):
+        entry = self.remote[rel]
+        file_name = os.path.join(self.local_dir, *rel.split("/"))
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        self.thunder_cl.download_file_with_retry(entry, file_name)
+        mtime = self._remote_mtime(entry)
+        os.utime(file_name, (mtime, mtime))
+
+
+class FolderWatcher(object):
+    """uploads the files that land in a local directory (--watch)
+
+    The directory is synced once (FolderSync), then watched. With
+    inotify_simple a file is complete when it is closed after writing or
+    moved in; without it (or where inotify fails) the tree is scanned every
+    interval seconds and a file is complete when its size and mtime stop
+    changing. Files nothing touched for settle seconds are uploaded
+    together, over the one logged-in client. Hidden, .part and .tmp files
+    are left alone. A file whose upload failed is tried again after
+    retry_delay seconds, doubling up to max_retry_delay.
+    """
+
+    ignore_suffixes = (".part", ".tmp")
+    retry_delay = 30.0
+    max_retry_delay = 3600.0
+
+    def __init__(self, thunder_cl, local_dir, folder=None, settle=2.0,
+                 interval=2.0, use_inotify=None):
+        self.thunder_cl = thunder_cl
+        self.logger = thunder_cl.logger
+        self.local_dir = local_dir
+        self.sync = FolderSync(thunder_cl, local_dir, folder)
+        self.settle = settle
+        self.interval = interval
+        if use_inotify is None:
+            use_inotify = inotify_simple is not None
+        self.use_inotify = use_inotify
+        self.inotify = None
+        self.watches = {}   # watch descriptor: relative dir prefix
+        self.pending = {}   # relative path: time of its last change
+        self.seen = {}      # relative path: (size, mtime), when polling
+        self.failures = {}  # relative path: failed uploads in a row
+        self.uploaded = 0
+        self.stop = threading.Event()
+
+    def _rel(self, path):
+        rel = os.path.relpath(path, self.local_dir).replace(os.sep, "/")
+        return "" if rel == "." else rel
+
+    def _wanted(self, rel):
+        return not any(part.startswith(".") for part in rel.split("/")) and\
+            not rel.endswith(self.ignore_suffixes)
+
+    def _plan(self):
+        """sync.plan() without the files the watcher leaves alone"""
+        return [rel for rel in self.sync.plan() if self._wanted(rel)]
+
+    def _start_inotify(self):
+        try:
+            self.inotify = inotify_simple.INotify()
+        except OSError as ex:
+            self.logger.warning("watch: inotify unavailable ({}), "
+                                "polling".format(ex))
+            return
+        for root, _, _ in os.walk(self.local_dir):
+            self._add_watch(root)
+
+    def _add_watch(self, path):
+        flags = inotify_simple.flags
+        try:
+            wd = self.inotify.add_watch(path, flags.CLOSE_WRITE |
+                                        flags.MOVED_TO | flags.CREATE)
+        except OSError as ex:
+            # removed again, or out of watches (fs.inotify.max_user_watches)
+            self.logger.warning("watch: can't watch '{}': {}".
+                                format(path, ex))
+            return
+        rel = self._rel(path)
+        self.watches[wd] = rel + "/" if rel else ""
+
+    def _inotify_changes(self, timeout):
+        flags = inotify_simple.flags
+        changed = []
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                # events were lost: compare the whole tree again
+                changed.extend(self._plan())
+                continue
+            prefix = self.watches.get(event.wd)
+            if prefix is None:
+                continue
+            if event.mask & flags.IGNORED:
+                del self.watches[event.wd]
+                continue
+            rel = prefix + event.name
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    # files can land before the new watch is in place
+                    path = os.path.join(self.local_dir, *rel.split("/"))
+                    for root, _, names in os.walk(path):
+                        self._add_watch(root)
+                        changed.extend(self._rel(os.path.join(root, name))
+                                       for name in names)
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                changed.append(rel)
+        return changed
+
+    def _scan_changes(self):
+        self.stop.wait(self.interval)
+        current = {rel: (st.st_size, st.st_mtime)
+                   for rel, st in self.sync.local_files().items()}
+        changed = [rel for rel, state in current.items()
+                   if self.seen.get(rel) != state]
+        self.seen = current
+        return changed
+
+    def _upload(self, ready):
+        batch = []
+        for rel in ready:
+            del self.pending[rel]
+            try:
+                self.sync.local[rel] = os.stat(
+                    os.path.join(self.local_dir, *rel.split("/")))
+            except OSError:
+                # gone again
+                continue
+            batch.append(rel)
+        if not batch:
+            return
+        self.logger.info("watch: uploading {} files".format(len(batch)))
+        try:
+            scheduler = self.sync.upload(batch)
+            done = scheduler.done
+            failed = [rel for rel, _ in scheduler.failed]
+        except Exception as ex:
+            # no target folder: nothing of the batch went up
+            self.logger.error("watch: upload failed: {}".format(ex))
+            done, failed = [], batch
+        self.uploaded += len(done)
+        for rel in done:
+            self.failures.pop(rel, None)
+        now = time.time()
+        for rel in failed:
+            tries = self.failures[rel] = self.failures.get(rel, 0) + 1
+            wait = min(self.retry_delay * 2 ** (tries - 1),
+                       self.max_retry_delay)
+            self.logger.info("watch: '{}' failed {} times, next try in "
+                             "{:.0f}s".format(rel, tries, wait))
+            # pending counts from the last change: due settle after wait
+            self.pending[rel] = now + wait
+
+    def run(self):
+        """watches until stop is set (or ctrl+C)"""
+        if self.use_inotify:
+            # watches first, so nothing slips in during the first sync
+            self._start_inotify()
+        todo = self._plan()
+        self.logger.info("sync: {} of {} files to upload".format(
+            len(todo), len(self.sync.local)))
+        self.sync.upload(todo)
+        self.seen = {rel: (st.st_size, st.st_mtime)
+                     for rel, st in self.sync.local.items()}
+        self.logger.info("watching '{}' ({})".format(
+            self.local_dir, "inotify" if self.inotify is not None else
+            "scan every {}s".format(self.interval)))
+        try:
+            while not self.stop.is_set():
+                if self.inotify is not None:
+                    changed = self._inotify_changes(
+                        min(self.interval, self.settle) if self.pending
+                        else self.interval)
+                else:
+                    changed = self._scan_changes()
+                now = time.time()
+                for rel in changed:
+                    if self._wanted(rel):
+                        self.pending[rel] = now
+                ready = sorted(rel for rel, changed_at in self.pending.items()
+                               if now - changed_at >= self.settle)
+                if ready:
+                    self._upload(ready)
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+
+
+class AsyncThunderDriveAPI(ThunderDriveBase):
+    """asyncio client with the operations of ThunderDriveAPI (needs aiohttp)
+
+    async with AsyncThunderDriveAPI(usr, psw) as thunder_cl:
+        rez = await thunder_cl.get_search_rez("phrase")
+        await asyncio.gather(*[thunder_cl.download_file_with_retry(x)
+                               for x in rez["data"]])
+    """
+
+    def __init__(self, usr, psw, logger=None, proxy=None, ssl_verify=True,
+                 limit=100, url=None):
+        if aiohttp is None:
+            raise ImportError("AsyncThunderDriveAPI needs aiohttp "
+                              "(pip3 install aiohttp)")
+        if logger is not None:
+            self.set_logger(logger)
+        self.retry_policy = RetryPolicy(self.logger)
+        if url is not None:
+            self.URL = url
+        self.user_name = usr
+        self._psw = psw
+        self.proxy = proxy
+        self.ssl_verify = ssl_verify
+        self.limit = limit
+        self.session = None
+        self.logged_in = False
+        self.userID = None
+        self.allFolders = None
+        self.last_resp = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit, ssl=None if self.ssl_verify else False)
+        # unsafe: keep cookies of ip address hosts too (local test servers)
+        self.session = aiohttp.ClientSession(
+            connector=connector, headers=self.headers,
+            cookie_jar=aiohttp.CookieJar(unsafe=True))
+        await self._retry(self._login, self.user_name, self._psw)
+
+    async def close(self):
+        try:
+            await self._logout()
+        finally:
+            await self.session.close()
+
+    async def _retry(self, func, *args, operation="request", **kwargs):
+        """async counterpart of RetryPolicy.call"""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as ex:
+                wait = self.retry_policy.should_retry(operation, attempt, ex)
+                if wait is None:
+                    raise
+                await asyncio.sleep(wait)
+            else:
+                self.retry_policy.succeeded()
+                return result
+
+    async def _login(self, usr, psw):
+        login_resp = await self.post(self.URL + "auth/login",
+                                     self._login_data(usr, psw),
+                                     test_resp=True)
+        if login_resp["status"] == "success":
+            self.logged_in = True
+            user = login_resp.get("user") or {}
+            self.userID = user.get("id")
+
+    async def _logout(self):
+        if self.logged_in:
+            self.logged_in = False
+            await self._retry(self.post, self.URL + "auth/logout", None)
+
+    def _xsrf_headers(self):
+        for cookie in self.session.cookie_jar:
+            if cookie.key == "XSRF-TOKEN":
+                return self._xsrf_header(cookie.value)
+        return {}
+
+    async def get(self, _url, params=None, test_resp=False, timeout=90):
+        async with self.session.get(
+                _url, params=params, proxy=self.proxy,
+                timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+            resp.raise_for_status()
+            content = await resp.read()
+        if test_resp:
+            self._test_resp(content)
+        return json.loads(content)
+
+    async def post(self, _url, _data, _json=None, test_resp=False,
+                   headers=None, convert_to_json=True, timeout=90):
+        headers = dict(headers or {}, **self._xsrf_headers())
+        async with self.session.post(
+                _url, data=_data, json=_json, proxy=self.proxy,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+            resp.raise_for_status()
+            content = await resp.read()
+        if test_resp:
+            self._test_resp(content)
+        if convert_to_json:
+            return json.loads(content)
+        return content
+
+    async def get_folders(self, folder_hash=""):
+        params = None
+        if folder_hash != "":
+            params = self._folder_params(folder_hash)
+        self.last_resp = await self._retry(self.get, self.URL + "drive/entries",
+                                           params=params)
+        return self.last_resp
+
+    async def get_folder_entries(self, folder_hash=""):
+        """all entries of one folder (root if no hash), every page"""
+        return await self._get_all_pages(
+            lambda page: self._folder_params(folder_hash, page))
+
+    async def _get_all_pages(self, params_for_page, limit=None):
+        """first page, then the remaining ones concurrently, in page order"""
+        first = await self._retry(self.get, self.URL + "drive/entries",
+                                  params=params_for_page(1))
+        entries = list(first["data"])
+        pages = range(2, int(first.get("last_page", 1)) + 1)
+        if limit is not None:
+            per_page = max(len(entries), 1)
+            pages = pages[:max(0, -(-(limit - len(entries)) // per_page))]
+        rest = await asyncio.gather(*[
+            self._retry(self.get, self.URL + "drive/entries",
+                        params=params_for_page(page)) for page in pages])
+        for resp in rest:
+            entries.extend(resp["data"])
+        return entries[:limit]
+
+    async def get_all_folders(self):
+        if self.userID is None:
+            await self.get_folders()
+            self.userID = self.get_user_id()
+        resp = await self._retry(self.get, self.URL +
+                                 "drive/users/{}/folders".format(self.userID))
+        self.allFolders = resp["folders"]
+        return self.allFolders
+
+    async def get_space_usage(self):
+        resp = await self._retry(self.get,
+                                 self.URL + "drive/user/space-usage")
+        return resp["used"], resp["available"]
+
+    async def get_search_rez(self, query):
+        self.logger.info("searching ({}) .....".format(query))
+        self.last_resp = await self._retry(self.get,
+                                           self.URL + "drive/entries",
+                                           params=self._search_params(query),
+                                           timeout=deftimeout)
+        return self.last_resp
+
+    async def get_recent(self, all=False, count=0):
+        entries = await self._get_all_pages(self._recent_params,
+                                            limit=None if all else count)
+        self.last_resp = {"data": entries}
+        return self.last_resp
+
+    async def make_folder(self, name, parent_id=None):
+        mk_resp = await self._retry(
+            self.post, self.URL + "drive/folders", None,
+            _json={"name": name, "parent_id": parent_id}, test_resp=True)
+        return mk_resp
+
+    async def download_file_with_retry(self, file_info, file_name=None):
+        await self._retry(self.download_file, file_info, file_name,
+                          operation="download")
+
+    async def download_file(self, file_info, file_name=None,
+                            chunk_size=1024 * 512):
+        file_size = int(file_info["file_size"])
+        file_name = file_name or file_info["name"]
+        part = PartialDownload(file_name, file_info)
+        # file work (writes, the fsync of every commit) runs in a thread,
+        # so other transfers on the loop go on meanwhile
+        offset = await asyncio.to_thread(part.load)
+        self.logger.info("B: " + file_name + " ("
+                         + Tools.sizeof_fmt(file_size) + ")")
+        if offset > 0 and offset >= file_size:
+            await asyncio.to_thread(part.finish)
+            return
+
+        headers = None
+        if offset > 0:
+            headers = {"Range": "bytes={}-".format(offset)}
+        async with self.session.get(
+                self.URL + "uploads/download",
+                params=[('hashes', file_info["hash"])], headers=headers,
+                proxy=self.proxy,
+                timeout=aiohttp.ClientTimeout(total=deftimeout)) as resp:
+            resp.raise_for_status()
+            if offset > 0 and resp.status != 206:
+                offset = 0
+            chC = offset
+            with await asyncio.to_thread(part.open, offset) as f:
+                try:
+                    async for ch in resp.content.iter_chunked(chunk_size):
+                        await asyncio.to_thread(f.write, ch)
+                        chC += len(ch)
+                        if part.due():
+                            await asyncio.to_thread(part.commit, f, chC)
+                finally:
+                    if chC != file_size:
+                        await asyncio.to_thread(part.commit, f, chC)
+
+        if chC != file_size:
+            raise Exception("{}: got {} of {} bytes".format(file_name, chC,
+                                                           file_size))
+        await asyncio.to_thread(part.finish)
+        self.logger.info("E: " + file_name)
+
+    async def upload_file_with_retry(self, filePath, folder_id=""):
+        await self._retry(self.upload_file, filePath, folder_id=folder_id,
+                          operation="upload")
+
+    async def upload_file(self, filePath, folder_id=""):
+        self.logger.info("B: uploading file '{}'".format(filePath))
+        with open(filePath, 'rb') as f:
+            form = aiohttp.FormData()
+            form.add_field('parentId', str(folder_id))
+            form.add_field('file', f, filename=os.path.basename(filePath))
+            await self.post(self.URL + "uploads", form,
+                            convert_to_json=False, timeout=deftimeout)
+        self.logger.info("E: uploading done '{}'".format(filePath))
 
 
 class InteractiveMode(object):
@@ -687,10 +3526,78 @@ def param_mode_help():
     print("     thunderdrive.py --uploadmode file1 file2 ...")
     print("--downloadmode - example:")
     print("     thunderdrive.py --downloadmode file1 file2 ...")
-    print("--targetdir=THdir - target directory in thinderdrive.io for upload")
+    print("--targetdir=THdir - target directory in thinderdrive.io for upload"
+          " (name or a/b/c path)")
+    print("--stdout - with --downloadmode/--search: write the (only) found"
+          " file to stdout, messages go to stderr")
+    print("     thunderdrive.py --downloadmode backup.tar.zst --stdout"
+          " | zstd -d | tar x")
+    print("--stdin --name=X - upload stdin as file X (into --targetdir)")
+    print("     tar c dir | thunderdrive.py --stdin --name=dir.tar"
+          " --targetdir=Backup")
     print("--parentdir=pdir - in which directory create new dir")
     print("--createdirifnotfound - will create direktory in pdir or in root dir")
+    print("--forceupload - upload even if targetdir has a file with the same"
+          " name and size")
     print("--printrecent=x - print x most recent items")
+    print("--find=*.jpg - list files of the local drive index"
+          " (~/.thunderdrive/index.db, new entries fetched first) by name,"
+          " or by path if the pattern has a /; with --downloadmode:"
+          " download them")
+    print("--regex=RE --type=image --minsize=1M --maxsize=1G"
+          " --after=2021-01-01 --before=2021-02-01 - more --find filters")
+    print("--feed - list entries added since the last --feed run"
+          " (~/.thunderdrive/feed.json; the first run only sets the mark);"
+          " with --downloadmode: download them")
+    print("--follow=60 - like --feed, then again every 60 seconds")
+    print("--reindex - rebuild the index from scratch (drops deleted and"
+          " moved files)")
+    print("--cached - reuse folder listings and search results for"
+          " --cachettl seconds (~/.thunderdrive/cache.db)")
+    print("--cachettl=600 - how long cached listings stay valid (seconds)")
+    print("--offline - no login, answer listings from the cache only")
+    print("--keepsession - reuse the login between runs"
+          " (~/.thunderdrive/session.json)")
+    print("--countrequests - print the number of api requests made")
+    print("--metrics=file.jsonl - append one JSON line per request, retry"
+          " and transfer")
+    print("--prometheus=file.prom - keep request / transfer totals in"
+          " Prometheus text format")
+    print("--sync=localdir - upload new/changed files of localdir (and"
+          " subdirs) to --targetdir")
+    print("--syncdown - with --sync: download new/changed files of"
+          " --targetdir to localdir")
+    print("--watch=localdir - sync localdir to --targetdir, then keep"
+          " running and upload every file that is written or moved into it")
+    print("--settle=2 - with --watch: upload a file once it was left"
+          " alone this many seconds")
+    print("--manifest - remember uploaded content (~/.thunderdrive/"
+          "manifest.db) and skip it next time; skip downloads whose local"
+          " copy has the same size")
+    print("--jobs=N - number of parallel downloads/uploads (default 1)")
+    print("--jobqueue - record uploads/downloads in ~/.thunderdrive/jobs.db"
+          " until they are done")
+    print("--resumejobs - run the unfinished jobs of earlier --jobqueue runs"
+          " (crashed, interrupted, failed) and exit")
+    print("--maxrate=10M - bandwidth limit shared by all transfers (bytes/s)")
+    print("--rateschedule=08:00-18:00=2M,18:00-08:00=0 - --maxrate by time"
+          " of day (0 - unlimited)")
+    print("--stallseconds=20 - restart a transfer slow for that long")
+    print("--stallratio=0.1 - slow: under this part of its recent peak speed")
+    print("--stallminrate=70K - slow: also under this speed (default off)")
+    print("--uploadtimeout=9000 - seconds to wait for the server's answer"
+          " after the last byte of an upload")
+    print("--segments=N - download files over 64MB with N connections each")
+    print("--poolsize=N - keep-alive connections per host (default: enough"
+          " for --jobs and --segments)")
+    print("--benchmark=100 - time that many folder listings (--jobs at a"
+          " time), print requests/s and exit")
+    print("--chunksize=1M - largest read / write of transfers")
+    print("--disablepreallocate - don't allocate the full size of a"
+          " download up front")
+    print("--retries=5 - tries per request / transfer (4xx errors are not"
+          " retried)")
+    print("--retrybudget=20 - retries all jobs together may make in a row")
 
 
 def param_mode(argv_full, logger):
@@ -713,6 +3620,39 @@ def param_mode(argv_full, logger):
     create_dir_if_not_found = False
     disableprogressbar = False
     printrecent = 0
+    jobs = 1
+    segments = 1
+    force_upload = False
+    cached = False
+    cache_ttl = 600
+    offline = False
+    keep_session = False
+    count_requests = False
+    metrics_file = None
+    prometheus_file = None
+    sync_dir = None
+    sync_down = False
+    watch_dir = None
+    settle = 2.0
+    use_manifest = False
+    max_rate = 0
+    rate_schedule = None
+    stall_settings = {}
+    upload_timeout = deftimeout
+    retry_settings = {"tries": 5}
+    pool_size = 0
+    benchmark = 0
+    chunk_size = None
+    preallocate = True
+    use_job_queue = False
+    resume_jobs = False
+    find = None
+    reindex = False
+    feed = False
+    follow = 0
+    to_stdout = False
+    from_stdin = False
+    stdin_name = None
     # downloadrandom = False
 
     try:
@@ -723,9 +3663,25 @@ def param_mode(argv_full, logger):
                            "uploadmode", "downloadmode",
                            "disableprogressbar",
                            "uploadfile=", "targetdir=",
-                           "createdirifnotfound",
+                           "createdirifnotfound", "forceupload",
                            "parentdir=",
-                           "printrecent="]
+                           "printrecent=", "jobs=", "segments=",
+                           "cached", "cachettl=", "offline",
+                           "keepsession", "countrequests",
+                           "metrics=", "prometheus=",
+                           "sync=", "syncdown", "watch=", "settle=",
+                           "manifest",
+                           "maxrate=", "rateschedule=",
+                           "stallseconds=", "stallratio=", "stallminrate=",
+                           "uploadtimeout=",
+                           "retries=", "retrybudget=",
+                           "poolsize=", "benchmark=",
+                           "stdout", "stdin", "name=",
+                           "chunksize=", "disablepreallocate",
+                           "jobqueue", "resumejobs",
+                           "find=", "regex=", "type=", "minsize=",
+                           "maxsize=", "after=", "before=", "reindex",
+                           "feed", "follow="]
                           )
     except getopt.GetoptError as err:
         print(err, file=sys.stderr)
@@ -761,6 +3717,8 @@ def param_mode(argv_full, logger):
             parent_directory = arg
         elif opt in ("--createdirifnotfound"):
             create_dir_if_not_found = True
+        elif opt == "--forceupload":
+            force_upload = True
         elif opt in ("--interactive"):
             interactive = True
         elif opt in ("--useproxy"):
@@ -770,6 +3728,105 @@ def param_mode(argv_full, logger):
         elif opt in ("--printrecent"):
             printrecent = int(arg)
             # printrecent_count = int(args)
+        elif opt == "--jobs":
+            jobs = int(arg)
+        elif opt == "--segments":
+            segments = int(arg)
+        elif opt == "--cached":
+            cached = True
+        elif opt == "--cachettl":
+            cache_ttl = int(arg)
+        elif opt == "--offline":
+            offline = True
+        elif opt == "--keepsession":
+            keep_session = True
+        elif opt == "--countrequests":
+            count_requests = True
+        elif opt == "--metrics":
+            metrics_file = arg
+        elif opt == "--prometheus":
+            prometheus_file = arg
+        elif opt == "--sync":
+            sync_dir = arg
+        elif opt == "--syncdown":
+            sync_down = True
+        elif opt == "--watch":
+            watch_dir = arg
+        elif opt == "--settle":
+            settle = float(arg)
+        elif opt == "--manifest":
+            use_manifest = True
+        elif opt == "--maxrate":
+            max_rate = Tools.parse_size(arg)
+        elif opt == "--rateschedule":
+            rate_schedule = RateLimiter.parse_schedule(arg)
+        elif opt == "--stallseconds":
+            stall_settings["grace"] = float(arg)
+        elif opt == "--stallratio":
+            stall_settings["ratio"] = float(arg)
+        elif opt == "--stallminrate":
+            stall_settings["min_rate"] = Tools.parse_size(arg)
+        elif opt == "--uploadtimeout":
+            upload_timeout = float(arg)
+        elif opt == "--retries":
+            retry_settings["tries"] = max(1, int(arg))
+        elif opt == "--retrybudget":
+            retry_settings["budget"] = int(arg)
+        elif opt == "--poolsize":
+            pool_size = int(arg)
+        elif opt == "--benchmark":
+            benchmark = int(arg)
+        elif opt == "--chunksize":
+            chunk_size = Tools.parse_size(arg)
+        elif opt == "--disablepreallocate":
+            preallocate = False
+        elif opt == "--jobqueue":
+            use_job_queue = True
+        elif opt == "--resumejobs":
+            use_job_queue = True
+            resume_jobs = True
+        elif opt == "--find":
+            find = dict(find or {}, glob=arg)
+        elif opt == "--regex":
+            find = dict(find or {}, regex=arg)
+        elif opt == "--type":
+            find = dict(find or {}, type=arg)
+        elif opt == "--minsize":
+            find = dict(find or {}, min_size=Tools.parse_size(arg))
+        elif opt == "--maxsize":
+            find = dict(find or {}, max_size=Tools.parse_size(arg))
+        elif opt == "--after":
+            find = dict(find or {}, after=Tools.parse_date(arg))
+        elif opt == "--before":
+            find = dict(find or {}, before=Tools.parse_date(arg))
+        elif opt == "--reindex":
+            reindex = True
+        elif opt == "--feed":
+            feed = True
+        elif opt == "--follow":
+            feed = True
+            follow = float(arg)
+        elif opt == "--stdout":
+            to_stdout = True
+        elif opt == "--stdin":
+            upload = True
+            from_stdin = True
+        elif opt == "--name":
+            stdin_name = arg
+
+    if from_stdin and not stdin_name:
+        print("--stdin needs --name", file=sys.stderr)
+        sys.exit(2)
+    data_out = None
+    if to_stdout:
+        # stdout carries the file: log, progress bar and prompts go to
+        # stderr
+        data_out = sys.stdout.buffer
+        if logger is not None:
+            for log_handler in logger.handlers:
+                if getattr(log_handler, "stream", None) is sys.stdout:
+                    log_handler.setStream(sys.stderr)
+        sys.stdout = sys.stderr
 
     https = http = None
     ssl_verify = True
@@ -778,59 +3835,167 @@ def param_mode(argv_full, logger):
         http = "http://192.168.10.221:8080"
         ssl_verify = False
 
+    cache = None
+    if cached or offline:
+        cache = MetadataCache(ttl=cache_ttl)
+
+    metrics = None
+    if metrics_file is not None or prometheus_file is not None:
+        metrics = Metrics(metrics_file, prometheus_file)
+
     usr, psw = get_login_info()
     # thunder_cl = ThunderDriveAPI(usr, psw, logger, https_proxy=https,
     #                                  http_proxy=http, ssl_verify=ssl_verify)
     with ThunderDriveAPI(usr, psw, logger, https_proxy=https,
                          http_proxy=http,
-                         ssl_verify=ssl_verify) as thunder_cl:
-        thunder_cl.tries = 1
-        thunder_cl.tries = 5
-
+                         ssl_verify=ssl_verify, cache=cache,
+                         offline=offline,
+                         session_file=ThunderDriveAPI.default_session_file
+                         if keep_session else None,
+                         manifest=Manifest() if use_manifest else None,
+                         metrics=metrics,
+                         job_queue=JobQueue() if use_job_queue else None)\
+            as thunder_cl:
+        thunder_cl.retry_policy = RetryPolicy(logger,
+                                              on_retry=thunder_cl._on_retry,
+                                              **retry_settings)
+
+        thunder_cl.count_requests = count_requests
         if disableprogressbar:
             thunder_cl.showprogressbar = False
+        thunder_cl.set_jobs(jobs)
+        thunder_cl.stall_settings = stall_settings
+        thunder_cl.upload_reply_timeout = upload_timeout
+        if max_rate > 0 or rate_schedule:
+            thunder_cl.rate_limiter = RateLimiter(max_rate, rate_schedule)
+        thunder_cl.set_segments(segments)
+        if pool_size:
+            thunder_cl.set_pool_size(pool_size)
+        if chunk_size:
+            thunder_cl.chunk_size = chunk_size
+        thunder_cl.preallocate_downloads = preallocate
+
+        if benchmark:
+            thunder_cl.benchmark_listing(benchmark)
+            sys.exit(0)
+
+        if resume_jobs:
+            thunder_cl.resume_jobs()
+            sys.exit(0)
 
         if interactive:
             InteractiveMode(thunder_cl)
             sys.exit(0)
 
+        if sync_dir is not None or watch_dir is not None:
+            folder = None
+            if target_directory is not None:
+                _, folder_hash =\
+                    thunder_cl.find_folder_id(target_directory,
+                                              parent_folder=parent_directory,
+                                              allow_create=create_dir_if_not_found)
+                if folder_hash == "":
+                    raise Exception("sync: target directory not found")
+                folder = thunder_cl.folders.by_hash[folder_hash]
+            if watch_dir is not None:
+                FolderWatcher(thunder_cl, watch_dir, folder,
+                              settle=settle).run()
+            else:
+                FolderSync(thunder_cl, sync_dir, folder,
+                           download=sync_down).run()
+            sys.exit(0)
+
         if upload:
+            thunder_cl.skip_existing = not force_upload
             folder_id = folder_hash = ""
             if target_directory is not None:
                 folder_id, folder_hash =\
                     thunder_cl.find_folder_id(target_directory,
                                               parent_folder=parent_directory,
                                               allow_create=create_dir_if_not_found)
+            if from_stdin:
+                thunder_cl.upload_stream(sys.stdin.buffer, stdin_name,
+                                         folder_id, folder_hash)
+                sys.exit(0)
             thunder_cl.upload_file_with_retry(upl_file_names, folder_id,
                                               folder_hash)
             sys.exit(0)
 
         if printrecent > 0:
-            thunder_cl.get_recent(count = printrecent)
+            recent = {"data": thunder_cl.iter_recent(count=printrecent)}
             if list_files or True:
-                InteractiveMode.print_items(_data=thunder_cl.last_resp,
+                InteractiveMode.print_items(_data=recent,
                                             user_name=thunder_cl.user_name,
                                             sep="|", sum_total=True)
             sys.exit(0)
 
+        if data_out is not None:
+            found = [x for x in thunder_cl.search_many(search_phrases)
+                     if x["type"] != "folder"]
+            exact = [x for x in found if x["name"] in search_phrases]
+            if len(found) > 1 and exact:
+                found = exact
+            if len(found) != 1:
+                raise Exception("--stdout: {} files found, need exactly one".
+                                format(len(found)))
+            thunder_cl.download_to_stream(found[0], data_out)
+            sys.exit(0)
+
+        if feed:
+            change_feed = ChangeFeed(thunder_cl, ChangeFeed.default_path)
+            while True:
+                try:
+                    # the mark moves only after the entries were handled
+                    new = {"data": change_feed.poll(commit=False)}
+                    if new["data"] and download:
+                        thunder_cl.download_all_search_results(new)
+                    elif new["data"]:
+                        InteractiveMode.print_items(
+                            _data=new, user_name=thunder_cl.user_name,
+                            sep="|")
+                except Exception as ex:
+                    if not follow:
+                        raise
+                    # not committed: the same entries come again next poll
+                    logger.error("feed: {}".format(ex))
+                else:
+                    change_feed.commit()
+                if not follow:
+                    break
+                time.sleep(follow)
+            sys.exit(0)
+
+        if find is not None or reindex:
+            index = DriveIndex()
+            if not offline:
+                index.refresh(thunder_cl, full=reindex)
+            if find is not None:
+                found = {"data": index.find(**find)}
+                if download:
+                    thunder_cl.download_all_search_results(found)
+                else:
+                    InteractiveMode.print_items(
+                        _data={"data": [dict(x, name=x["path_name"])
+                                        for x in found["data"]]},
+                        user_name=thunder_cl.user_name, sep="|")
+            sys.exit(0)
+
         if search and not download:
-            for search_phrase in search_phrases:
-                thunder_cl.get_search_rez(search_phrase)
-                if list_files:
-                    InteractiveMode.print_items(_data=thunder_cl.last_resp,
-                                                user_name=thunder_cl.user_name)
+            thunder_cl.get_search_many(search_phrases)
+            if list_files:
+                InteractiveMode.print_items(_data=thunder_cl.last_resp,
+                                            user_name=thunder_cl.user_name)
             sys.exit(0)
 
         if download:
-            for search_phrase in search_phrases:
-                thunder_cl.get_search_rez(search_phrase)
-                if list_files:
-                    InteractiveMode.print_items(_data=thunder_cl.last_resp,
-                                                user_name=thunder_cl.user_name)
-                if prompt:
-                    input("press enter to continue download; ctrl+C - to stop")
-                thunder_cl.\
-                    download_all_search_results(thunder_cl.last_resp)
+            # every phrase at once; a file matching two is downloaded once
+            thunder_cl.get_search_many(search_phrases)
+            if list_files:
+                InteractiveMode.print_items(_data=thunder_cl.last_resp,
+                                            user_name=thunder_cl.user_name)
+            if prompt:
+                input("press enter to continue download; ctrl+C - to stop")
+            thunder_cl.download_all_search_results(thunder_cl.last_resp)
             logger.info("All files downloaded")
             sys.exit(0)
 
@@ -906,4 +4071,4 @@ if __name__ == "__main__":
     finally:
         pass
 
-sys.exit(0)
+    sys.exit(0)